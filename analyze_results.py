@@ -1,95 +1,190 @@
 import os
-import json
 import torch
+import torch._dynamo
 import numpy as np
 from PIL import Image
-from torchvision import transforms
+from torch.utils.data import Subset
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend, plots are only saved to disk
 import matplotlib.pyplot as plt
 from collections import defaultdict
 import statistics
 
-from model import CatLandmarkModel
-from inference import predict_landmarks
+from model_utils import load_cat_model
+from dataset import CatLandmarkDataset, build_loader, load_landmarks
+from inference import DEFAULT_TRANSFORM, get_normalize, load_image_tensor, predict_batch
 
 
-def analyze_validation_results(test_data_dir, model_path, num_samples=50):
+# Preprocessing shared by every evaluated image: inference.py's uint8 Resize + PILToTensor
+# pipeline, normalized on the device by predict_batch
+eval_transform = DEFAULT_TRANSFORM
+
+
+class CudaPrefetcher:
+    """
+    Iterate a DataLoader while copying the next batch's images to the GPU on a side stream
+    
+    The host-to-device copy of batch i+1 overlaps the forward pass of batch i. The
+    DataLoader's pin_memory=True already stages each batch in pinned memory, which is
+    what makes the non_blocking copy asynchronous.
+    """
+    
+    def __init__(self, loader, device):
+        self.batches = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self._preload()
+    
+    def _preload(self):
+        try:
+            images, *rest = next(self.batches)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            images = images.to(self.device, non_blocking=True)
+        self.next_batch = (images, *rest)
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        # Tell the allocator the copied tensor is now used on the compute stream
+        batch[0].record_stream(current_stream)
+        self._preload()
+        return batch
+
+
+# Compiler/tracer failures that fall back to eager; anything else is a real error and propagates
+OPTIMIZE_ERRORS = (torch._dynamo.exc.TorchDynamoException, torch.jit.Error, torch.jit.TracingCheckError)
+
+
+def pad_batch(images, batch_size):
+    """Zero-pad a short (tail) batch to batch_size so the optimized model sees one fixed shape"""
+    if len(images) == batch_size:
+        return images
+    return torch.cat([images, images.new_zeros((batch_size - len(images), *images.shape[1:]))])
+
+
+def optimize_for_inference(model, device, batch_size):
+    """
+    Compile (CUDA) or trace (CPU) the model for a fixed batch_size and warm it up
+    
+    The warm-up goes through predict_batch, so it runs under the same inference_mode,
+    autocast and channels_last layout as the analysis; pad every batch with pad_batch.
+    Falls back to the eager model if the installed PyTorch can't compile/trace it.
+    """
+    example = torch.zeros(batch_size, 3, 224, 224, dtype=torch.uint8)
+    try:
+        if device.type == 'cuda':
+            optimized = torch.compile(model, mode='reduce-overhead')
+        else:
+            traced_input = get_normalize(device)(example).contiguous(memory_format=torch.channels_last)
+            with torch.no_grad():
+                optimized = torch.jit.trace(model, traced_input)
+        # torch.compile is lazy, so compilation errors surface here
+        predict_batch(optimized, example, device)
+    except OPTIMIZE_ERRORS as e:
+        print(f"Warning: could not optimize model, using eager mode ({e})")
+        return model
+    return optimized
+
+
+def analyze_validation_results(test_data_dir, model_path, num_samples=50, batch_size=16, num_workers=None):
     """Comprehensive analysis of model validation results"""
     
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"Using device: {device}\n")
     
     # Load model
-    model = CatLandmarkModel(num_landmarks=48, backbone='resnet18', pretrained=False)
-    checkpoint = torch.load(model_path, map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
-    model.to(device)
-    model.eval()
+    model = load_cat_model(model_path, str(device))
+    inference_model = optimize_for_inference(model, device, batch_size)
     
     image_dir = os.path.join(test_data_dir, 'images')
     label_dir = os.path.join(test_data_dir, 'labels')
     
-    # Get image files
-    image_files = sorted([f for f in os.listdir(image_dir) 
-                         if f.endswith('.png') and not f.endswith('_landmarks.png') and not f.endswith('_comparison.png')])[:num_samples]
-    
-    results = []
-    nme_values = []
-    
-    print(f"Analyzing {len(image_files)} images...\n")
-    
-    for img_file in image_files:
-        img_path = os.path.join(image_dir, img_file)
-        label_path = os.path.join(label_dir, img_file.replace('.png', '.json'))
-        
-        # Load ground truth
-        with open(label_path, 'r') as f:
-            gt_data = json.load(f)
-        gt_landmarks = np.array(gt_data['labels'], dtype=np.float32)
-        
-        # Predict
-        pred_landmarks, _ = predict_landmarks(model, img_path, device, save_vis=False)
-        
-        # Load image for size
-        image = Image.open(img_path).convert('RGB')
-        img_width, img_height = image.size
-        
-        # Normalize GT landmarks
-        gt_normalized = gt_landmarks.copy()
-        gt_normalized[:, 0] /= img_width
-        gt_normalized[:, 1] /= img_height
-        
-        # Normalize predictions
-        pred_normalized = pred_landmarks.copy()
-        pred_normalized[:, 0] /= img_width
-        pred_normalized[:, 1] /= img_height
-        
-        # Calculate inter-ocular distance
-        eye_dist = np.linalg.norm(gt_normalized[8] - gt_normalized[11])
-        eye_dist = max(eye_dist, 1e-5)
-        
-        # Calculate errors per landmark
-        errors = np.linalg.norm(pred_normalized - gt_normalized, axis=1)
-        mean_error = np.mean(errors)
-        nme = mean_error / eye_dist
-        
-        # Calculate per-landmark errors
-        landmark_errors = errors / eye_dist
-        
-        results.append({
-            'image': img_file,
-            'nme': nme,
-            'mean_error': mean_error,
-            'max_landmark_error': np.max(landmark_errors),
-            'min_landmark_error': np.min(landmark_errors),
-            'std_error': np.std(landmark_errors),
-            'image_size': (img_width, img_height),
-            'errors': landmark_errors
-        })
-        
-        nme_values.append(nme)
-    
-    # Sort by NME
-    results_sorted = sorted(results, key=lambda x: x['nme'])
+    # The first num_samples images in the dataset's sorted order; the dataset returns
+    # landmarks already normalized by the original image size
+    full_dataset = CatLandmarkDataset(image_dir, label_dir, transform=eval_transform)
+    num_images = min(num_samples, len(full_dataset))
+    image_files = full_dataset.image_files[:num_images]
+    dataset = Subset(full_dataset, range(num_images))
+    
+    print(f"Analyzing {num_images} images...\n")
+    
+    # Image decode and label parsing run in worker processes, overlapping the forward passes
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    loader = build_loader(dataset, batch_size=batch_size, num_workers=num_workers)
+    
+    if device.type == 'cuda':
+        # Start from a clean allocator cache and overlap H2D copies with compute
+        torch.cuda.empty_cache()
+        batches = CudaPrefetcher(loader, device)
+    else:
+        batches = loader
+    
+    # Preallocated (N, 48, 2) buffers filled batch by batch
+    gt_normalized = np.empty((num_images, 48, 2), dtype=np.float32)
+    pred_normalized = np.empty((num_images, 48, 2), dtype=np.float32)
+    offset = 0
+    
+    # predict_batch normalizes on the device and runs fp16 autocast on GPU only;
+    # metrics below are always computed in fp32
+    for images, gt_landmarks in batches:
+        end = offset + len(gt_landmarks)
+        # The tail batch is padded to batch_size and the padding rows dropped
+        predictions = predict_batch(inference_model, pad_batch(images, batch_size), device)
+        pred_normalized[offset:end] = predictions[:end - offset]
+        gt_normalized[offset:end] = gt_landmarks.view(-1, 48, 2).numpy()
+        offset = end
+    
+    # Release cached allocator blocks held by the batched forward passes
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    
+    # Calculate inter-ocular distance per image
+    eye_dist = np.linalg.norm(gt_normalized[:, 8] - gt_normalized[:, 11], axis=1)
+    eye_dist = np.maximum(eye_dist, 1e-5)
+    
+    # Calculate errors per landmark, shape (N, 48)
+    errors = np.linalg.norm(pred_normalized - gt_normalized, axis=2)
+    mean_errors = errors.mean(axis=1)
+    nme_values = mean_errors / eye_dist
+    
+    # Calculate per-landmark errors
+    landmark_errors = errors / eye_dist[:, None]
+    max_errors = landmark_errors.max(axis=1)
+    min_errors = landmark_errors.min(axis=1)
+    std_errors = landmark_errors.std(axis=1)
+    
+    # One record per image; fields can be read as whole columns (results['nme'])
+    results = np.empty(len(image_files), dtype=[
+        ('image', f'U{max(len(f) for f in image_files)}'),
+        ('nme', np.float32),
+        ('mean_error', np.float32),
+        ('max_landmark_error', np.float32),
+        ('min_landmark_error', np.float32),
+        ('std_error', np.float32),
+        ('image_size', np.int32, (2,)),
+        ('errors', np.float32, (48,)),
+    ])
+    results['image'] = image_files
+    results['nme'] = nme_values
+    results['mean_error'] = mean_errors
+    results['max_landmark_error'] = max_errors
+    results['min_landmark_error'] = min_errors
+    results['std_error'] = std_errors
+    # Original (width, height) from the PNG headers, no pixel decode
+    results['image_size'] = [Image.open(os.path.join(image_dir, f)).size for f in image_files]
+    results['errors'] = landmark_errors
+    
+    q1, q3 = np.percentile(nme_values, [25, 75])
     
     # Print statistics
     print("=" * 80)
@@ -102,49 +197,44 @@ def analyze_validation_results(test_data_dir, model_path, num_samples=50):
     print(f"  Std NME: {np.std(nme_values):.6f}")
     print(f"  Min NME: {np.min(nme_values):.6f}")
     print(f"  Max NME: {np.max(nme_values):.6f}")
-    print(f"  25th percentile: {np.percentile(nme_values, 25):.6f}")
-    print(f"  75th percentile: {np.percentile(nme_values, 75):.6f}")
+    print(f"  25th percentile: {q1:.6f}")
+    print(f"  75th percentile: {q3:.6f}")
     
     # Categorize results
-    excellent = [r for r in results if r['nme'] < 0.5]
-    good = [r for r in results if 0.5 <= r['nme'] < 1.0]
-    fair = [r for r in results if 1.0 <= r['nme'] < 2.0]
-    poor = [r for r in results if r['nme'] >= 2.0]
+    excellent, good, fair, poor = count_categories(nme_values)
     
     print(f"\nPerformance Categories:")
-    print(f"  Excellent (NME < 0.5): {len(excellent)} images ({100*len(excellent)/len(results):.1f}%)")
-    print(f"  Good (0.5 ≤ NME < 1.0): {len(good)} images ({100*len(good)/len(results):.1f}%)")
-    print(f"  Fair (1.0 ≤ NME < 2.0): {len(fair)} images ({100*len(fair)/len(results):.1f}%)")
-    print(f"  Poor (NME ≥ 2.0): {len(poor)} images ({100*len(poor)/len(results):.1f}%)")
+    print(f"  Excellent (NME < 0.5): {excellent} images ({100*excellent/len(results):.1f}%)")
+    print(f"  Good (0.5 ≤ NME < 1.0): {good} images ({100*good/len(results):.1f}%)")
+    print(f"  Fair (1.0 ≤ NME < 2.0): {fair} images ({100*fair/len(results):.1f}%)")
+    print(f"  Poor (NME ≥ 2.0): {poor} images ({100*poor/len(results):.1f}%)")
     
     # Best and worst images
     print(f"\nTop 5 Best Performing Images:")
-    for i, result in enumerate(results_sorted[:5], 1):
-        print(f"  {i}. {result['image']}: NME = {result['nme']:.6f}")
+    for i, idx in enumerate(top_k_indices(nme_values, 5), 1):
+        print(f"  {i}. {results['image'][idx]}: NME = {nme_values[idx]:.6f}")
     
     print(f"\nTop 5 Worst Performing Images:")
-    for i, result in enumerate(results_sorted[-5:][::-1], 1):
-        print(f"  {i}. {result['image']}: NME = {result['nme']:.6f}")
+    for i, idx in enumerate(top_k_indices(nme_values, 5, largest=True), 1):
+        print(f"  {i}. {results['image'][idx]}: NME = {nme_values[idx]:.6f}")
     
     # Analyze outliers
-    q1 = np.percentile(nme_values, 25)
-    q3 = np.percentile(nme_values, 75)
     iqr = q3 - q1
     outlier_threshold = q3 + 1.5 * iqr
     
-    outliers = [r for r in results if r['nme'] > outlier_threshold]
-    print(f"\nOutliers (NME > {outlier_threshold:.3f}): {len(outliers)} images")
-    for outlier in sorted(outliers, key=lambda x: x['nme'], reverse=True):
-        print(f"  {outlier['image']}: NME = {outlier['nme']:.6f}")
+    outlier_idx = np.flatnonzero(nme_values > outlier_threshold)
+    outlier_idx = outlier_idx[np.argsort(nme_values[outlier_idx])[::-1]]
+    print(f"\nOutliers (NME > {outlier_threshold:.3f}): {len(outlier_idx)} images")
+    for idx in outlier_idx:
+        print(f"  {results['image'][idx]}: NME = {nme_values[idx]:.6f}")
     
     # Analyze landmark-specific errors
     print(f"\nLandmark Error Analysis:")
-    all_landmark_errors = np.array([r['errors'] for r in results])
-    landmark_means = np.mean(all_landmark_errors, axis=0)
-    landmark_stds = np.std(all_landmark_errors, axis=0)
+    landmark_means = landmark_errors.mean(axis=0)
+    landmark_stds = landmark_errors.std(axis=0)
     
-    worst_landmarks = np.argsort(landmark_means)[-5:][::-1]
-    best_landmarks = np.argsort(landmark_means)[:5]
+    worst_landmarks = top_k_indices(landmark_means, 5, largest=True)
+    best_landmarks = top_k_indices(landmark_means, 5)
     
     print(f"  Worst performing landmarks (highest mean error):")
     for idx in worst_landmarks:
@@ -155,13 +245,37 @@ def analyze_validation_results(test_data_dir, model_path, num_samples=50):
         print(f"    Landmark {idx}: mean error = {landmark_means[idx]:.6f} ± {landmark_stds[idx]:.6f}")
     
     # Create visualization
-    create_analysis_plots(results, nme_values, test_data_dir)
+    create_analysis_plots(results, nme_values, test_data_dir, model=model, device=device)
     
     return results
 
 
-def create_analysis_plots(results, nme_values, output_dir):
+def top_k_indices(values, k, largest=False):
+    """Indices of the k smallest (or largest) values in sorted order, using argpartition instead of a full sort"""
+    k = min(k, len(values))
+    if k == len(values):
+        idx = np.arange(len(values))
+    elif largest:
+        idx = np.argpartition(values, -k)[-k:]
+    else:
+        idx = np.argpartition(values, k)[:k]
+    
+    order = np.argsort(values[idx])
+    return idx[order[::-1]] if largest else idx[order]
+
+
+def count_categories(nme_values):
+    """Count images in the excellent / good / fair / poor NME bands"""
+    excellent = np.count_nonzero(nme_values < 0.5)
+    good = np.count_nonzero((nme_values >= 0.5) & (nme_values < 1.0))
+    fair = np.count_nonzero((nme_values >= 1.0) & (nme_values < 2.0))
+    poor = np.count_nonzero(nme_values >= 2.0)
+    return excellent, good, fair, poor
+
+
+def create_analysis_plots(results, nme_values, output_dir, model, device):
     """Create visualization plots for analysis"""
+    plt.rcParams['path.simplify'] = True
     
     # 1. NME distribution histogram
     fig, axes = plt.subplots(2, 2, figsize=(15, 12))
@@ -183,8 +297,8 @@ def create_analysis_plots(results, nme_values, output_dir):
     axes[0, 1].grid(True, alpha=0.3)
     
     # Sorted NME values
-    sorted_nme = sorted(nme_values)
-    axes[1, 0].plot(range(len(sorted_nme)), sorted_nme, marker='o', markersize=3)
+    sorted_nme = np.sort(nme_values)
+    axes[1, 0].plot(sorted_nme, linewidth=1)
     axes[1, 0].axhline(np.mean(nme_values), color='r', linestyle='--', label=f'Mean: {np.mean(nme_values):.3f}')
     axes[1, 0].set_xlabel('Image Index (sorted)')
     axes[1, 0].set_ylabel('NME')
@@ -193,10 +307,7 @@ def create_analysis_plots(results, nme_values, output_dir):
     axes[1, 0].grid(True, alpha=0.3)
     
     # Performance categories pie chart
-    excellent = len([r for r in results if r['nme'] < 0.5])
-    good = len([r for r in results if 0.5 <= r['nme'] < 1.0])
-    fair = len([r for r in results if 1.0 <= r['nme'] < 2.0])
-    poor = len([r for r in results if r['nme'] >= 2.0])
+    excellent, good, fair, poor = count_categories(nme_values)
     
     categories = ['Excellent\n(NME < 0.5)', 'Good\n(0.5 ≤ NME < 1.0)', 
                   'Fair\n(1.0 ≤ NME < 2.0)', 'Poor\n(NME ≥ 2.0)']
@@ -208,35 +319,61 @@ def create_analysis_plots(results, nme_values, output_dir):
     
     plt.tight_layout()
     plot_path = os.path.join(output_dir, 'validation_analysis.png')
-    plt.savefig(plot_path, dpi=150, bbox_inches='tight')
+    plt.savefig(plot_path, dpi=100)
     print(f"\nSaved analysis plots to: {plot_path}")
     plt.close()
     
     # Create comparison for worst cases
-    worst_results = sorted(results, key=lambda x: x['nme'], reverse=True)[:3]
-    create_outlier_comparisons(worst_results, output_dir)
+    worst_results = results[top_k_indices(results['nme'], 3, largest=True)]
+    create_outlier_comparisons(worst_results, output_dir, model, device)
 
 
-def create_outlier_comparisons(worst_results, output_dir):
-    """Create comparison visualizations for worst performing images"""
-    from compare_predictions import compare_prediction_gt
-    
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = CatLandmarkModel(num_landmarks=48, backbone='resnet18', pretrained=False)
-    checkpoint = torch.load('checkpoints/best_model.pth', map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
-    model.to(device)
-    model.eval()
+def create_outlier_comparisons(worst_results, output_dir, model, device):
+    """Create one GT vs. prediction comparison grid for the worst performing images"""
+    if len(worst_results) == 0:
+        return
     
     image_dir = os.path.join(output_dir, 'images')
     label_dir = os.path.join(output_dir, 'labels')
     
     print(f"\nCreating comparison visualizations for worst cases...")
+    
+    # Load images and ground truth with the same preprocessing as the main analysis
+    tensors = []
+    images = []
+    gt_landmarks = []
     for result in worst_results:
         img_file = result['image']
-        img_path = os.path.join(image_dir, img_file)
-        label_path = os.path.join(label_dir, img_file.replace('.png', '.json'))
-        compare_prediction_gt(img_path, label_path, model, device)
+        img_tensor, image = load_image_tensor(os.path.join(image_dir, img_file), transform=eval_transform)
+        tensors.append(img_tensor)
+        images.append(image)
+        gt_landmarks.append(load_landmarks(os.path.join(label_dir, img_file.replace('.png', '.json'))))
+    
+    # Predict all worst cases in a single forward pass
+    pred_normalized = predict_batch(model, torch.stack(tensors), device)
+    
+    # One row per image: ground truth on the left, prediction on the right
+    fig, axes = plt.subplots(len(images), 2, figsize=(20, 10 * len(images)), squeeze=False)
+    for row, (result, img, gt, pred) in enumerate(zip(worst_results, images, gt_landmarks, pred_normalized)):
+        pred_landmarks = pred * np.array(img.size, dtype=np.float32)
+        img_array = np.array(img)
+        
+        axes[row, 0].imshow(img_array)
+        axes[row, 0].scatter(gt[:, 0], gt[:, 1], c='green', s=30, marker='o', edgecolors='white', linewidths=1)
+        axes[row, 0].set_title(f"Ground Truth - {result['image']}", fontsize=16)
+        axes[row, 0].axis('off')
+        
+        axes[row, 1].imshow(img_array)
+        axes[row, 1].scatter(pred_landmarks[:, 0], pred_landmarks[:, 1], c='red', s=30, marker='o', edgecolors='white', linewidths=1)
+        axes[row, 1].set_title(f"Prediction - NME = {result['nme']:.3f}", fontsize=16)
+        axes[row, 1].axis('off')
+    
+    plt.tight_layout()
+    
+    save_path = os.path.join(output_dir, 'worst_case_comparisons.png')
+    plt.savefig(save_path, bbox_inches='tight', dpi=150)
+    print(f"Saved comparison to {save_path}")
+    plt.close()
 
 
 if __name__ == '__main__':
@@ -1,37 +1,56 @@
 import os
+import numpy as np
 import torch
-from torch.utils.data import Dataset, random_split
-from dataset import CatLandmarkDataset
+from torch.utils.data import random_split
 
 # Recreate the same split as training
 data_dir = '/Users/elaine01px2019/Downloads/CatFLW dataset'
 image_dir = os.path.join(data_dir, 'images')
 label_dir = os.path.join(data_dir, 'labels')
-
-# Create full dataset without transform for splitting (same as training)
-full_dataset = CatLandmarkDataset(image_dir, label_dir, transform=None)
-
-# Split dataset indices (same as training - 20% validation split)
-val_split = 0.2
-val_size = int(len(full_dataset) * val_split)
-train_size = len(full_dataset) - val_size
-train_split, val_split_indices = random_split(full_dataset, [train_size, val_size])
-
-print(f"Total dataset size: {len(full_dataset)}")
+split_cache_path = os.path.join('checkpoints', 'split_indices.npz')
+
+# Get all image files (sorted, same filter as CatLandmarkDataset)
+with os.scandir(image_dir) as entries:
+    all_image_files = sorted([e.name for e in entries
+                             if e.name.endswith('.png') and '_landmarks' not in e.name and '_comparison' not in e.name])
+
+split_seed = 42
+split = np.load(split_cache_path) if os.path.exists(split_cache_path) else None
+
+# Reuse the split computed on a previous run, unless the dataset size or seed changed since
+if (split is not None and 'num_images' in split and int(split['num_images']) == len(all_image_files)
+        and int(split['seed']) == split_seed):
+    train_indices = split['train'].tolist()
+    val_indices = split['val'].tolist()
+    print(f"Loaded split indices from {split_cache_path}")
+else:
+    # Split dataset indices (same as training - 20% validation split)
+    val_split = 0.2
+    val_size = int(len(all_image_files) * val_split)
+    train_size = len(all_image_files) - val_size
+    train_split, val_split_indices = random_split(range(len(all_image_files)), [train_size, val_size],
+                                                  generator=torch.Generator().manual_seed(split_seed))
+    train_indices = train_split.indices
+    val_indices = val_split_indices.indices
+    
+    os.makedirs(os.path.dirname(split_cache_path), exist_ok=True)
+    np.savez(split_cache_path, train=np.array(train_indices), val=np.array(val_indices),
+             num_images=len(all_image_files), seed=split_seed)
+    print(f"Saved split indices to {split_cache_path}")
+
+train_size = len(train_indices)
+val_size = len(val_indices)
+print(f"Total dataset size: {train_size + val_size}")
 print(f"Train samples: {train_size}, Val samples: {val_size}\n")
 
-# Get the actual image filenames for train and validation sets
-train_indices = train_split.indices
-val_indices = val_split_indices.indices
-
-# Get all image files (sorted)
-all_image_files = sorted([f for f in os.listdir(image_dir) 
-                         if f.endswith('.png') and '_landmarks' not in f and '_comparison' not in f])
-
 # Get filenames for train and val sets
 train_files = [all_image_files[i] for i in train_indices]
 val_files = [all_image_files[i] for i in val_indices]
 
+# Sets for O(1) membership checks
+train_set = set(train_files)
+val_set = set(val_files)
+
 print(f"Train set: {len(train_files)} images")
 print(f"Validation set: {len(val_files)} images\n")
 
@@ -47,9 +66,9 @@ val_count = 0
 unknown_count = 0
 
 for img_file in test_files:
-    if img_file in train_files:
+    if img_file in train_set:
         train_count += 1
-    elif img_file in val_files:
+    elif img_file in val_set:
         val_count += 1
     else:
         unknown_count += 1
@@ -65,7 +84,7 @@ if train_count > 0:
     print("   Performance metrics may be inflated.\n")
     print("Images in training set:")
     for img_file in test_files:
-        if img_file in train_files:
+        if img_file in train_set:
             print(f"  - {img_file}")
 else:
     print("✓ All test images were in the validation set (not seen during training)")
@@ -83,7 +102,7 @@ for img in val_files[:10]:
 
 print(f"\nFirst 10 TEST images (first 10 of the 50 we tested):")
 for img in test_files[:10]:
-    in_train = "✓ TRAIN" if img in train_files else ""
-    in_val = "✓ VAL" if img in val_files else ""
+    in_train = "✓ TRAIN" if img in train_set else ""
+    in_val = "✓ VAL" if img in val_set else ""
     print(f"  {img} {in_train} {in_val}")
 
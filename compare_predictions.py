@@ -1,43 +1,76 @@
 """Compare ground truth and predictions side by side"""
 
 import torch
-import json
 import numpy as np
-from PIL import Image
-from torchvision import transforms
-import matplotlib.pyplot as plt
+from PIL import Image, ImageDraw
 
-from model import CatLandmarkModel
+from model_utils import load_cat_model
+from dataset import load_landmarks
 from inference import visualize_landmarks
 
 
-def compare_prediction_gt(image_path, label_path, model, device):
-    """Compare prediction vs ground truth"""
+# ImageNet statistics, shaped to broadcast over a (3, H, W) array
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+
+
+def preprocess_image(img, img_size=(224, 224)):
+    """
+    Resize + ToTensor + Normalize done directly in NumPy
+    
+    Matches the torchvision pipeline (Resize uses PIL bilinear resampling) and
+    returns a float32 array of shape (3, H, W).
+    """
+    arr = np.asarray(img.resize(img_size, Image.BILINEAR), dtype=np.float32).transpose(2, 0, 1) / 255.0
+    return (arr - IMAGENET_MEAN) / IMAGENET_STD
+
+
+def draw_landmarks(img, landmarks, color, radius):
+    """Draw landmarks as filled dots with a white outline on a copy of a PIL image"""
+    img = img.copy()
+    draw = ImageDraw.Draw(img)
+    for x, y in landmarks:
+        draw.ellipse([(x - radius, y - radius), (x + radius, y + radius)], fill=color, outline='white')
+    return img
+
+
+def compare_prediction_gt(image_path, label_path, model, device, pretty=False):
+    """
+    Compare prediction vs ground truth
+    
+    By default the dots are drawn straight onto the image with Pillow; pass
+    pretty=True for the titled matplotlib figure.
+    """
     # Load image and GT
     img = Image.open(image_path).convert('RGB')
-    with open(label_path, 'r') as f:
-        gt_data = json.load(f)
-    gt_landmarks = np.array(gt_data['labels'], dtype=np.float32)
+    gt_landmarks = load_landmarks(label_path)
     
     # Predict
     original_size = img.size
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    
-    img_tensor = transform(img).unsqueeze(0).to(device)
+    img_tensor = torch.from_numpy(preprocess_image(img)).unsqueeze(0).to(device)
     
     model.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         predictions = model(img_tensor)
     
     # Reshape predictions
     landmarks_normalized = predictions.cpu().numpy().reshape(48, 2)
-    pred_landmarks = landmarks_normalized.copy()
-    pred_landmarks[:, 0] *= original_size[0]
-    pred_landmarks[:, 1] *= original_size[1]
+    pred_landmarks = landmarks_normalized * np.array(original_size, dtype=np.float32)
+    
+    save_path = image_path.replace('.png', '_comparison.png')
+    
+    if not pretty:
+        # Ground truth on the left, prediction on the right
+        radius = max(2, round(max(original_size) / 200))
+        width, height = original_size
+        comparison = Image.new('RGB', (2 * width, height))
+        comparison.paste(draw_landmarks(img, gt_landmarks, 'green', radius), (0, 0))
+        comparison.paste(draw_landmarks(img, pred_landmarks, 'red', radius), (width, 0))
+        comparison.save(save_path, 'PNG', optimize=False, compress_level=1)
+        print(f"Saved comparison to {save_path}")
+        return
+    
+    import matplotlib.pyplot as plt
     
     # Create comparison visualization
     fig, axes = plt.subplots(1, 2, figsize=(20, 10))
@@ -58,7 +91,6 @@ def compare_prediction_gt(image_path, label_path, model, device):
     plt.tight_layout()
     
     # Save
-    save_path = image_path.replace('.png', '_comparison.png')
     plt.savefig(save_path, bbox_inches='tight', dpi=150)
     print(f"Saved comparison to {save_path}")
     plt.close()
@@ -68,7 +100,7 @@ if __name__ == '__main__':
     import sys
     
     if len(sys.argv) < 2:
-        print("Usage: python compare_predictions.py <image_path>")
+        print("Usage: python compare_predictions.py <image_path> [--pretty]")
         sys.exit(1)
     
     image_path = sys.argv[1]
@@ -76,11 +108,7 @@ if __name__ == '__main__':
     
     # Load model
     device = torch.device('cpu')
-    model = CatLandmarkModel(num_landmarks=48, pretrained=False)
-    checkpoint = torch.load('checkpoints/best_model.pth', map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
-    model.to(device)
-    model.eval()
+    model = load_cat_model('checkpoints/best_model.pth', str(device))
     
-    compare_prediction_gt(image_path, label_path, model, device)
+    compare_prediction_gt(image_path, label_path, model, device, pretty='--pretty' in sys.argv[2:])
 
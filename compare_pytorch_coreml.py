@@ -7,57 +7,63 @@ import torch
 import coremltools as ct
 import numpy as np
 from PIL import Image
-from torchvision import transforms
-from model import CatLandmarkModel
+from model_utils import load_cat_model
+from compare_predictions import preprocess_image
 import os
 
-def compare_models(image_path, model_path='checkpoints/best_model.pth', coreml_path='CatLandmarkModel.mlpackage'):
-    """Compare PyTorch and Core ML model outputs"""
+
+def preprocess_images(image_paths):
+    """Preprocess images into a single (B, 3, 224, 224) float32 array plus original sizes"""
+    arrays = []
+    original_sizes = []
+    for image_path in image_paths:
+        image = Image.open(image_path).convert('RGB')
+        original_sizes.append(image.size)
+        arrays.append(preprocess_image(image))
+    
+    return np.stack(arrays), original_sizes
+
+
+def compare_models(image_path, model_path='checkpoints/best_model.pth', coreml_path='CatLandmarkModel.mlpackage',
+                   pytorch_model=None, coreml_model=None):
+    """Compare PyTorch and Core ML model outputs
     
-    # Load image
-    image = Image.open(image_path).convert('RGB')
-    original_size = image.size
+    Already loaded models can be passed in to avoid reloading them for every image.
+    """
+    
+    # Load image and apply PyTorch preprocessing
+    img_array, (original_size,) = preprocess_images([image_path])
+    img_tensor = torch.from_numpy(img_array)
     print(f"Image: {image_path}")
     print(f"Original size: {original_size}")
-    
-    # PyTorch preprocessing
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    
-    img_tensor = transform(image).unsqueeze(0)
     print(f"\nPyTorch tensor shape: {img_tensor.shape}")
     print(f"PyTorch tensor range: [{img_tensor.min():.4f}, {img_tensor.max():.4f}]")
     
     # Load PyTorch model
-    device = torch.device('cpu')
-    pytorch_model = CatLandmarkModel(num_landmarks=48, backbone='resnet18', pretrained=False)
-    checkpoint = torch.load(model_path, map_location=device)
-    pytorch_model.load_state_dict(checkpoint['model_state_dict'])
-    pytorch_model.eval()
+    if pytorch_model is None:
+        pytorch_model = load_cat_model(model_path)
     
     # PyTorch prediction
-    with torch.no_grad():
+    with torch.inference_mode():
         pytorch_output = pytorch_model(img_tensor)
     
-    pytorch_landmarks = pytorch_output.cpu().numpy().reshape(48, 2)
+    # Input is already on the CPU, so no device transfer is needed
+    pytorch_landmarks = pytorch_output.numpy().reshape(48, 2)
     print(f"\nPyTorch output shape: {pytorch_landmarks.shape}")
     print(f"PyTorch output range: [{pytorch_landmarks.min():.4f}, {pytorch_landmarks.max():.4f}]")
     print(f"First 5 landmarks: {pytorch_landmarks[:5]}")
     
     # Load Core ML model
-    if not os.path.exists(coreml_path):
-        print(f"\n❌ Core ML model not found: {coreml_path}")
-        print("   Run: python convert_to_coreml.py")
-        return
-    
-    coreml_model = ct.models.MLModel(coreml_path)
+    if coreml_model is None:
+        if not os.path.exists(coreml_path):
+            print(f"\n❌ Core ML model not found: {coreml_path}")
+            print("   Run: python convert_to_coreml.py")
+            return
+        coreml_model = ct.models.MLModel(coreml_path)
     
     # Prepare input for Core ML (same as PyTorch)
     # Convert tensor to numpy and reshape to [1, 3, 224, 224]
-    coreml_input = {"image": img_tensor.numpy()}
+    coreml_input = {"image": img_array}
     
     # Core ML prediction
     coreml_output = coreml_model.predict(coreml_input)
@@ -97,6 +103,54 @@ def compare_models(image_path, model_path='checkpoints/best_model.pth', coreml_p
     else:
         print("❌ Models have significant differences - check preprocessing!")
 
+def compare_models_batch(image_paths, model_path='checkpoints/best_model.pth', coreml_path='CatLandmarkModel.mlpackage'):
+    """Compare PyTorch and Core ML model outputs over many images
+    
+    Both models are loaded once, PyTorch runs a single batched forward pass and
+    Core ML runs one batch prediction call.
+    """
+    if not os.path.exists(coreml_path):
+        print(f"❌ Core ML model not found: {coreml_path}")
+        print("   Run: python convert_to_coreml.py")
+        return
+    
+    pytorch_model = load_cat_model(model_path)
+    coreml_model = ct.models.MLModel(coreml_path)
+    
+    batch, original_sizes = preprocess_images(image_paths)
+    print(f"Comparing {len(image_paths)} images, batch shape: {batch.shape}")
+    
+    # PyTorch prediction for the whole batch
+    with torch.inference_mode():
+        pytorch_output = pytorch_model(torch.from_numpy(batch))
+    pytorch_landmarks = pytorch_output.numpy().reshape(-1, 48, 2)
+    
+    # Core ML prediction - the converted model has a fixed (1, 3, 224, 224) input,
+    # so pass one input dict per image to a single batch predict call
+    coreml_inputs = [{"image": batch[i:i + 1]} for i in range(len(batch))]
+    coreml_outputs = coreml_model.predict(coreml_inputs)
+    coreml_landmarks = np.stack([out["landmarks"].reshape(48, 2) for out in coreml_outputs])
+    
+    # Compare in pixel coordinates
+    sizes = np.array(original_sizes, dtype=np.float32)[:, None, :]
+    pixel_diff = np.abs(pytorch_landmarks - coreml_landmarks) * sizes
+    
+    print(f"\n📏 Pixel coordinate differences per image:")
+    for image_path, diff in zip(image_paths, pixel_diff):
+        print(f"   {os.path.basename(image_path)}: mean={diff.mean():.2f}, max={diff.max():.2f} pixels")
+    
+    print(f"\n📊 Overall:")
+    print(f"   Mean: {pixel_diff.mean():.2f} pixels")
+    print(f"   Max: {pixel_diff.max():.2f} pixels")
+    
+    if pixel_diff.mean() < 1.0:
+        print("✅ Models are very close!")
+    elif pixel_diff.mean() < 5.0:
+        print("⚠️  Models have moderate differences")
+    else:
+        print("❌ Models have significant differences - check preprocessing!")
+
+
 if __name__ == '__main__':
     import sys
     if len(sys.argv) > 1:
@@ -104,5 +158,11 @@ if __name__ == '__main__':
     else:
         image_path = "/Users/elaine01px2019/Downloads/CatFLW dataset/images/00000001_000.png"
     
-    compare_models(image_path)
+    if os.path.isdir(image_path):
+        # Compare on every image in a folder
+        image_paths = sorted(os.path.join(image_path, f) for f in os.listdir(image_path)
+                             if f.endswith('.png') and '_landmarks' not in f and '_comparison' not in f)
+        compare_models_batch(image_paths)
+    else:
+        compare_models(image_path)
 
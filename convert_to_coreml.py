@@ -12,7 +12,7 @@ import torch
 import coremltools as ct
 import numpy as np
 from PIL import Image
-from model import CatLandmarkModel
+from model_utils import load_cat_model
 import argparse
 import os
 
@@ -28,20 +28,11 @@ def convert_to_coreml(model_path, output_path, backbone='resnet18', format='mlpr
     """
     print(f"Loading PyTorch model from {model_path}...")
     
-    # Load model
-    device = torch.device('cpu')  # Core ML conversion requires CPU
-    model = CatLandmarkModel(num_landmarks=48, backbone=backbone, pretrained=False)
-    
-    if os.path.exists(model_path):
-        checkpoint = torch.load(model_path, map_location=device)
-        model.load_state_dict(checkpoint['model_state_dict'])
-        print(f"✅ Loaded model from {model_path}")
-        if 'val_loss' in checkpoint:
-            print(f"   Model val_loss: {checkpoint['val_loss']:.6f}")
-    else:
+    # Load model (Core ML conversion requires CPU)
+    if not os.path.exists(model_path):
         raise FileNotFoundError(f"Model file not found: {model_path}")
-    
-    model.eval()
+    model = load_cat_model(model_path, 'cpu', backbone)
+    print(f"✅ Loaded model from {model_path}")
     
     # Create example input (224x224 RGB image)
     example_input = torch.randn(1, 3, 224, 224)
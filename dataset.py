@@ -1,79 +1,218 @@
 import os
+import copy
 import json
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 import numpy as np
 from torchvision import transforms
+from torchvision.io import read_image, ImageReadMode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def load_landmarks(label_path):
+    """Load the (48, 2) landmark array from a CatFLW JSON label file"""
+    if orjson is not None:
+        with open(label_path, 'rb') as f:
+            label_data = orjson.loads(f.read())
+    else:
+        with open(label_path, 'r') as f:
+            label_data = json.load(f)
+    return np.array(label_data['labels'], dtype=np.float32)
 
 
 class CatLandmarkDataset(Dataset):
     """Dataset class for Cat Facial Landmark Detection"""
     
-    def __init__(self, image_dir, label_dir, transform=None, normalize_landmarks=True):
+    def __init__(self, image_dir, label_dir, transform=None, normalize_landmarks=True, tensor_decode=False):
         """
         Args:
             image_dir: Path to directory containing cat images
             label_dir: Path to directory containing JSON label files
             transform: Optional torchvision transforms to apply
             normalize_landmarks: If True, normalize landmarks to [0, 1] range
+            tensor_decode: If True, decode with torchvision.io.read_image into a uint8
+                (3, H, W) tensor instead of a PIL image; transform must then accept
+                tensors (e.g. transforms.v2), and without one the uint8 tensor is returned
         """
         self.image_dir = image_dir
         self.label_dir = label_dir
-        self.transform = transform
         self.normalize_landmarks = normalize_landmarks
+        self.tensor_decode = tensor_decode
+        self.set_transform(transform)
         
         # Get all image files (exclude landmarks and comparison images)
         self.image_files = sorted([f for f in os.listdir(image_dir) 
                                    if f.endswith('.png') and '_landmarks' not in f and '_comparison' not in f])
         
+        # Full image and label paths, built once instead of on every __getitem__
+        self._img_paths = [os.path.join(image_dir, f) for f in self.image_files]
+        self._label_paths = [os.path.join(label_dir, f[:-4] + '.json') for f in self.image_files]
+        
         # Number of landmarks (48 based on the dataset)
         self.num_landmarks = 48
         
+    def set_transform(self, transform):
+        """Set the transform and the Resize target size used for JPEG draft decoding"""
+        self.transform = transform
+        
+        # Get the target size from transform (if Resize is present), looked up once here
+        # instead of on every __getitem__
+        self._target_size = None
+        for t in getattr(transform, 'transforms', []):
+            if isinstance(t, transforms.Resize):
+                self._target_size = tuple(t.size) if isinstance(t.size, (tuple, list)) else (t.size, t.size)
+                break
+    
     def __len__(self):
         return len(self.image_files)
     
     def __getitem__(self, idx):
         # Load image
-        img_name = self.image_files[idx]
-        img_path = os.path.join(self.image_dir, img_name)
-        image = Image.open(img_path).convert('RGB')
-        original_size = image.size  # (width, height)
+        if self.tensor_decode:
+            # libpng/libjpeg decode straight into a uint8 tensor, no PIL image in between
+            image = read_image(self._img_paths[idx], ImageReadMode.RGB)
+            original_size = (image.shape[2], image.shape[1])  # (width, height)
+        else:
+            image = Image.open(self._img_paths[idx])
+            original_size = image.size  # (width, height), read before any draft downscaling
+            
+            # For JPEGs, let libjpeg(-turbo) decode at a reduced DCT scale that is still
+            # at least the Resize target, skipping the full-resolution intermediate (no-op for PNG)
+            if self._target_size is not None:
+                image.draft('RGB', self._target_size)
+            image = image.convert('RGB')
         
         # Load corresponding label
-        label_name = img_name.replace('.png', '.json')
-        label_path = os.path.join(self.label_dir, label_name)
-        
-        with open(label_path, 'r') as f:
-            label_data = json.load(f)
-        
-        landmarks = np.array(label_data['labels'], dtype=np.float32)  # Shape: (48, 2)
-        
-        # Get the target size from transform (if Resize is present)
-        target_size = original_size
-        if self.transform:
-            for t in self.transform.transforms if hasattr(self.transform, 'transforms') else []:
-                if isinstance(t, transforms.Resize):
-                    target_size = t.size if isinstance(t.size, tuple) else (t.size, t.size)
-                    break
+        landmarks = load_landmarks(self._label_paths[idx])  # Shape: (48, 2)
         
         # Normalize landmarks to original image size
         # During training, image will be resized but landmarks stay normalized to original
         # During inference, we multiply by original size to get pixel coordinates
         if self.normalize_landmarks:
-            orig_width, orig_height = original_size
-            landmarks[:, 0] = landmarks[:, 0] / orig_width
-            landmarks[:, 1] = landmarks[:, 1] / orig_height
+            landmarks /= np.array(original_size, dtype=np.float32)
         
-        # Apply transforms (if provided, should include ToTensor)
+        # Apply transforms (if provided, should include ToTensor for PIL images).
+        # Decoded tensors stay uint8 (3, H, W) without a transform, like CachedCatLandmarkDataset;
+        # ImageNetNormalize does the float conversion on the device
         if self.transform:
             image = self.transform(image)
-        else:
+        elif not self.tensor_decode:
             # Default transform to tensor
             image = transforms.ToTensor()(image)
         
         # Flatten landmarks to (96,) shape: [x1, y1, x2, y2, ..., x48, y48]
-        landmarks_flat = landmarks.flatten()
+        # (from_numpy shares the float32 buffer instead of copying it)
+        return image, torch.from_numpy(landmarks.reshape(-1))
+
+
+class TransformSubset(Dataset):
+    """
+    Subset of a CatLandmarkDataset (or CachedCatLandmarkDataset) that applies its own transform
+    
+    Wraps a shallow copy of the base dataset, so train and val splits share one
+    directory scan and path list but can use different transforms.
+    """
+    
+    def __init__(self, dataset, indices, transform):
+        self.dataset = copy.copy(dataset)
+        self.dataset.set_transform(transform)
+        self.indices = indices
+    
+    def __len__(self):
+        return len(self.indices)
+    
+    def __getitem__(self, idx):
+        return self.dataset[self.indices[idx]]
+
+
+class CachedCatLandmarkDataset(Dataset):
+    """
+    CatFLW samples pre-decoded by precompute.py into memory-mapped .npy files
+    
+    __getitem__ is an indexed slice of the memmap: no PIL decode, no JSON parsing
+    and no per-sample filesystem access. Images are returned as uint8 (3, H, W)
+    tensors, like CatLandmarkDataset with tensor_decode=True; ImageNet normalization
+    is left to the device (ImageNetNormalize). Images are stored already resized,
+    so any transform must not include Resize.
+    """
+    
+    def __init__(self, cache_dir, transform=None):
+        """
+        Args:
+            cache_dir: Directory containing images.npy (N, H, W, 3) uint8, landmarks.npy (N, 96) float32
+                and image_files.txt (N filenames, in the same order)
+            transform: Optional uint8 tensor transforms (e.g. v2.ColorJitter)
+        """
+        self.images_path = os.path.join(cache_dir, 'images.npy')
+        self.landmarks_path = os.path.join(cache_dir, 'landmarks.npy')
+        self.set_transform(transform)
+        
+        with open(os.path.join(cache_dir, 'image_files.txt')) as f:
+            self.image_files = f.read().splitlines()
+        
+        # A partially written cache would silently misalign images, labels and filenames
+        num_images = len(np.load(self.images_path, mmap_mode='r'))
+        num_landmarks = len(np.load(self.landmarks_path, mmap_mode='r'))
+        if not num_images == num_landmarks == len(self.image_files):
+            raise ValueError(f"Inconsistent cache in {cache_dir}: {num_images} images, {num_landmarks} landmarks, "
+                             f"{len(self.image_files)} filenames; rerun precompute.py")
         
-        return image, torch.FloatTensor(landmarks_flat)
+        # Memmaps are opened lazily so each DataLoader worker maps the files itself
+        # instead of receiving a pickled copy of the arrays
+        self.images = None
+        self.landmarks = None
+        self._length = num_images
+        
+        self.num_landmarks = 48
+    
+    def set_transform(self, transform):
+        """Set the transform (lets TransformSubset give each split its own)"""
+        self.transform = transform
+    
+    def __len__(self):
+        return self._length
+    
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = np.load(self.images_path, mmap_mode='r')
+            self.landmarks = np.load(self.landmarks_path, mmap_mode='r')
+        
+        # Copy out of the read-only memmap, HWC -> CHW uint8 in the same copy
+        image = torch.from_numpy(np.ascontiguousarray(self.images[idx].transpose(2, 0, 1)))
+        if self.transform:
+            image = self.transform(image)
+        
+        return image, torch.from_numpy(np.array(self.landmarks[idx]))
 
+
+def build_loader(dataset, batch_size, num_workers=None, shuffle=False, prefetch_factor=2, **kwargs):
+    """
+    Create a DataLoader that preprocesses samples in persistent worker processes
+    
+    Args:
+        dataset: Dataset to load from (e.g. CatLandmarkDataset or a Subset of it)
+        batch_size: Samples per batch
+        num_workers: Worker processes (default: half the CPU cores, 0 loads in the main process)
+        shuffle: Whether to shuffle every epoch
+        prefetch_factor: Batches prefetched per worker; keep this small, larger values
+            don't improve throughput but hold on to more pinned memory
+        **kwargs: Passed through to DataLoader (e.g. drop_last, sampler)
+    """
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 2) // 2)
+    
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        pin_memory=torch.cuda.is_available(),
+        **kwargs
+    )
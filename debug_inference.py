@@ -2,16 +2,12 @@ import torch
 import json
 import numpy as np
 from PIL import Image
-from torchvision import transforms
-from model import CatLandmarkModel
+from model_utils import load_cat_model
+from inference import DEFAULT_TRANSFORM, get_normalize
 
 # Load model
 device = torch.device('cpu')
-model = CatLandmarkModel(num_landmarks=48, backbone='resnet18', pretrained=False)
-checkpoint = torch.load('checkpoints/best_model.pth', map_location=device)
-model.load_state_dict(checkpoint['model_state_dict'])
-model.to(device)
-model.eval()
+model = load_cat_model('checkpoints/best_model.pth', str(device))
 
 # Test image
 image_path = "/Users/elaine01px2019/Downloads/CatFLW dataset/images/00000001_000.png"
@@ -30,19 +26,14 @@ print(f"GT landmarks shape: {gt_landmarks.shape}")
 print(f"GT landmarks range: x=[{gt_landmarks[:, 0].min():.2f}, {gt_landmarks[:, 0].max():.2f}], y=[{gt_landmarks[:, 1].min():.2f}, {gt_landmarks[:, 1].max():.2f}]")
 
 # Normalize GT for comparison
-gt_normalized = gt_landmarks.copy()
-gt_normalized[:, 0] /= original_size[0]
-gt_normalized[:, 1] /= original_size[1]
+size = np.array(original_size, dtype=np.float32)
+gt_normalized = gt_landmarks / size
 print(f"GT normalized range: x=[{gt_normalized[:, 0].min():.4f}, {gt_normalized[:, 0].max():.4f}], y=[{gt_normalized[:, 1].min():.4f}, {gt_normalized[:, 1].max():.4f}]")
 
-# Transform and predict
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-])
-
-img_tensor = transform(image).unsqueeze(0).to(device)
+# Transform and predict - resize to uint8 on the CPU with the shared inference
+# pipeline, normalize on the device
+img_tensor = DEFAULT_TRANSFORM(image).unsqueeze(0).to(device, non_blocking=True)
+img_tensor = get_normalize(device)(img_tensor)
 
 with torch.no_grad():
     predictions = model(img_tensor)
@@ -53,9 +44,7 @@ print(f"\nPredicted landmarks (normalized) shape: {pred_landmarks_normalized.sha
 print(f"Predicted normalized range: x=[{pred_landmarks_normalized[:, 0].min():.4f}, {pred_landmarks_normalized[:, 0].max():.4f}], y=[{pred_landmarks_normalized[:, 1].min():.4f}, {pred_landmarks_normalized[:, 1].max():.4f}]")
 
 # Denormalize predictions
-pred_landmarks = pred_landmarks_normalized.copy()
-pred_landmarks[:, 0] *= original_size[0]
-pred_landmarks[:, 1] *= original_size[1]
+pred_landmarks = pred_landmarks_normalized * size
 print(f"Predicted landmarks (pixels) range: x=[{pred_landmarks[:, 0].min():.2f}, {pred_landmarks[:, 0].max():.2f}], y=[{pred_landmarks[:, 1].min():.2f}, {pred_landmarks[:, 1].max():.2f}]")
 
 # Calculate error
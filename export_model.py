@@ -0,0 +1,59 @@
+"""
+Export the PyTorch Cat Landmark Model to ONNX for ONNX Runtime inference
+
+Usage:
+    python export_model.py --model checkpoints/best_model.pth --output cat_landmarks.onnx
+"""
+
+import argparse
+import os
+
+import torch
+
+from model_utils import load_cat_model
+
+
+def export_to_onnx(model_path, output_path, backbone='resnet18', opset_version=17):
+    """
+    Export a trained checkpoint to ONNX with a dynamic batch dimension
+    
+    Args:
+        model_path: Path to PyTorch checkpoint (.pth file)
+        output_path: Output path for the .onnx file
+        backbone: Model backbone architecture
+        opset_version: ONNX opset to target
+    """
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model file not found: {model_path}")
+    model = load_cat_model(model_path, 'cpu', backbone)
+    
+    # Input: ImageNet-normalized (N, 3, 224, 224) float32
+    # Output: (N, 96) landmarks normalized to [0, 1]
+    example_input = torch.randn(1, 3, 224, 224)
+    torch.onnx.export(
+        model,
+        example_input,
+        output_path,
+        input_names=['input'],
+        output_names=['landmarks'],
+        opset_version=opset_version,
+        dynamic_axes={'input': {0: 'N'}, 'landmarks': {0: 'N'}},
+    )
+    print(f"✅ ONNX model saved to: {output_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export PyTorch model to ONNX')
+    parser.add_argument('--model', type=str, default='checkpoints/best_model.pth',
+                        help='Path to PyTorch checkpoint')
+    parser.add_argument('--output', type=str, default='cat_landmarks.onnx',
+                        help='Output path for the ONNX model')
+    parser.add_argument('--backbone', type=str, default='resnet18',
+                        help='Model backbone (resnet18, resnet34, resnet50)')
+    
+    args = parser.parse_args()
+    export_to_onnx(args.model, args.output, args.backbone)
+
+
+if __name__ == '__main__':
+    main()
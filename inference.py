@@ -1,40 +1,124 @@
 import os
+import functools
+from collections import namedtuple
 from sympy import Q
 import torch
-import json
+from torch.utils.data import Subset
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw
 from torchvision import transforms
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 
-from model import CatLandmarkModel
+from model import CatLandmarkModel, ImageNetNormalize
+from model_utils import load_cat_model, load_checkpoint
+from dataset import CatLandmarkDataset, build_loader
 
 
-def visualize_landmarks(image_path, landmarks, save_path=None):
-    """Visualize landmarks on the image"""
-    # Load image
-    img = Image.open(image_path).convert('RGB')
-    img_array = np.array(img)
+@functools.lru_cache(maxsize=None)
+def get_normalize(device):
+    """
+    uint8 -> normalized float conversion with its buffers on device
     
-    # Create figure
-    fig, ax = plt.subplots(1, 1, figsize=(12, 12))
-    ax.imshow(img_array)
-    ax.axis('off')
+    One instance per device, so moving it for one caller never changes the
+    device another caller's instance lives on.
+    """
+    return ImageNetNormalize().to(device)
+
+# Result of predict_landmarks
+LandmarkPrediction = namedtuple('LandmarkPrediction', ['landmarks', 'landmarks_normalized', 'image', 'original_size'])
+
+
+def visualize_landmarks(image, landmarks, save_path=None):
+    """
+    Draw landmarks onto the image with Pillow and return it as a PIL image
     
-    # Plot landmarks
-    ax.scatter(landmarks[:, 0], landmarks[:, 1], c='red', s=50, marker='o', edgecolors='white', linewidths=1)
+    Args:
+        image: Path to the image, or an already loaded RGB PIL image (drawn on in place)
+        landmarks: Array of shape (48, 2) in pixel coordinates
+        save_path: Optional path to save the visualization to
+    """
+    img = Image.open(image).convert('RGB') if isinstance(image, str) else image
+    draw = ImageDraw.Draw(img)
     
-    plt.tight_layout()
+    # Dot size scales with the image so points stay visible on large photos
+    r = max(3, round(max(img.size) / 150))
+    for x, y in landmarks:
+        draw.ellipse([x - r, y - r, x + r, y + r], fill='red', outline='white')
     
     if save_path:
-        plt.savefig(save_path, bbox_inches='tight', dpi=150)
+        img.save(save_path)
         print(f"Saved visualization to {save_path}")
-    return plt
+    return img
+
+
+def prepare_for_inference(model, device):
+    """Move the model to device in channels_last layout (fp16 weights on CUDA) and set eval mode"""
+    model = model.to(device, memory_format=torch.channels_last)
+    if device.type == 'cuda':
+        model = model.half()
+    return model.eval()
+
+
+@functools.lru_cache(maxsize=None)
+def get_inference_transform(img_size=(224, 224)):
+    """Resize + PILToTensor pipeline (uint8 output), built once per image size"""
+    return transforms.Compose([
+        transforms.Resize(img_size),
+        transforms.PILToTensor()
+    ])
 
 
+# Shared 224x224 pipeline, also used by debug_inference.py and test_preprocessing.py so
+# every path preprocesses identically
+DEFAULT_TRANSFORM = get_inference_transform()
 
-def predict_landmarks(model, image_path, device, img_size=(224, 224), save_vis=False):
+
+def load_image_tensor(image_path, img_size=(224, 224), transform=None):
+    """
+    Load an image and resize it into a uint8 (3, H, W) tensor
+    
+    Args:
+        transform: PIL -> uint8 tensor transform (default: the cached pipeline for img_size)
+    
+    Returns:
+        img_tensor: uint8 tensor, normalized later on the device by predict_batch
+        image: The decoded RGB PIL image (image.size is the original (width, height))
+    """
+    image = Image.open(image_path).convert('RGB')
+    if transform is None:
+        transform = get_inference_transform(img_size)
+    return transform(image), image
+
+
+def predict_batch(model, images, device):
+    """
+    Run one forward pass over a batch of images
+    
+    Args:
+        model: Trained model
+        images: (B, 3, H, W) uint8 tensor from load_image_tensor, or an already normalized float tensor
+        device: torch device
+    
+    Returns:
+        Array of shape (B, 48, 2) with normalized [0, 1] coordinates
+    """
+    # Pinned host memory lets the non_blocking copy run asynchronously on the DMA engine
+    # (DataLoader batches are already pinned when pin_memory=True)
+    if device.type == 'cuda' and images.device.type == 'cpu' and not images.is_pinned():
+        images = images.pin_memory()
+    images = images.to(device, non_blocking=True)
+    if images.dtype == torch.uint8:
+        images = get_normalize(images.device)(images)
+    images = images.contiguous(memory_format=torch.channels_last)
+    
+    # fp16 on CUDA; the model's final sigmoid still runs in float32
+    model.eval()
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+        predictions = model(images)
+    
+    return predictions.float().cpu().numpy().reshape(-1, 48, 2)
+
+
+def predict_landmarks(model, image_path, device, img_size=(224, 224), save_vis=False, transform=None):
     """
     Predict landmarks for a single image
     
@@ -44,92 +128,75 @@ def predict_landmarks(model, image_path, device, img_size=(224, 224), save_vis=F
         device: torch device
         img_size: Input image size for model
         save_vis: Whether to save visualization
+        transform: PIL -> uint8 tensor transform (default: the cached pipeline for img_size)
     
     Returns:
-        landmarks: Array of shape (47, 2) with normalized [0, 1] coordinates
+        LandmarkPrediction with fields
+        landmarks: Array of shape (48, 2) in original image pixel coordinates
+        landmarks_normalized: Array of shape (48, 2) with normalized [0, 1] coordinates
+        image: The loaded PIL image with the landmarks drawn on it (call .show() to display)
+        original_size: (width, height) of the image on disk
     """
-    # Load and preprocess image
-    image = Image.open(image_path).convert('RGB')
-    original_size = image.size  # (width, height)
-    
-    # Transform
-    transform = transforms.Compose([
-        transforms.Resize(img_size),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    
-    img_tensor = transform(image).unsqueeze(0).to(device)
+    # Load and preprocess image, keeping the decoded image around for the visualization
+    img_tensor, image = load_image_tensor(image_path, img_size, transform)
+    original_size = image.size
     
     # Predict
-    model.eval()
-    with torch.no_grad():
-        predictions = model(img_tensor)
-    
-    # Reshape to (num_landmarks, 2)
-    landmarks_normalized = predictions.cpu().numpy().reshape(48, 2)
+    landmarks_normalized = predict_batch(model, img_tensor.unsqueeze(0), device)[0]
     
     # Denormalize to original image coordinates
-    landmarks = landmarks_normalized.copy()
-    landmarks[:, 0] *= original_size[0]  # x coordinates
-    landmarks[:, 1] *= original_size[1]  # y coordinates
+    landmarks = landmarks_normalized * np.array(original_size, dtype=np.float32)
     
     # Visualize if requested
     vis_path = image_path.replace('.png', '_landmarks.png').replace('.jpg', '_landmarks.jpg') if save_vis else None
-    plt = visualize_landmarks(image_path, landmarks, vis_path)
+    image = visualize_landmarks(image, landmarks, vis_path)
     
-    return landmarks, landmarks_normalized, plt
+    return LandmarkPrediction(landmarks, landmarks_normalized, image, original_size)
 
 
-def evaluate_model(model, test_data_dir, device, num_samples=10):
+def evaluate_model(model, test_data_dir, device, num_samples=10, batch_size=16, num_workers=None, save_vis=True):
     """Evaluate model on test images"""
     image_dir = os.path.join(test_data_dir, 'images')
     label_dir = os.path.join(test_data_dir, 'labels')
     
-    # Get only actual image files, exclude _landmarks.png files
-    image_files = sorted([f for f in os.listdir(image_dir) 
-                         if f.endswith('.png') and not f.endswith('_landmarks.png') and not f.endswith('_comparison.png')])[:num_samples]
+    # CatLandmarkDataset skips _landmarks.png / _comparison.png files and returns
+    # landmarks normalized by the original image size
+    dataset = CatLandmarkDataset(image_dir, label_dir, transform=get_inference_transform())
+    num_samples = min(num_samples, len(dataset))
+    loader = build_loader(Subset(dataset, range(num_samples)), batch_size, num_workers=num_workers)
     
-    total_nme = 0.0
+    pred_all = []
+    nme_values = []
     
-    for img_file in image_files:
-        img_path = os.path.join(image_dir, img_file)
-        label_path = os.path.join(label_dir, img_file.replace('.png', '.json'))
-        
-        # Load ground truth
-        with open(label_path, 'r') as f:
-            gt_data = json.load(f)
-        gt_landmarks = np.array(gt_data['labels'], dtype=np.float32)
-        
-        # Predict
-        pred_landmarks, _ = predict_landmarks(model, img_path, device, save_vis=True)
-        
-        # Calculate NME
-        image = Image.open(img_path).convert('RGB')
-        img_width, img_height = image.size
-        
-        # Normalize GT landmarks
-        gt_normalized = gt_landmarks.copy()
-        gt_normalized[:, 0] /= img_width
-        gt_normalized[:, 1] /= img_height
+    for images, landmarks in loader:
+        # Predict the whole batch at once
+        pred_normalized = predict_batch(model, images, device)
+        gt_normalized = landmarks.numpy().reshape(-1, 48, 2)
         
         # Calculate inter-ocular distance
-        eye_dist = np.linalg.norm(gt_normalized[8] - gt_normalized[11])
-        eye_dist = max(eye_dist, 1e-5)  # Avoid division by zero
+        eye_dist = np.linalg.norm(gt_normalized[:, 8] - gt_normalized[:, 11], axis=1)
+        eye_dist = np.maximum(eye_dist, 1e-5)  # Avoid division by zero
         
         # Calculate mean error
-        pred_normalized = pred_landmarks.copy()
-        pred_normalized[:, 0] /= img_width
-        pred_normalized[:, 1] /= img_height
-        
-        errors = np.linalg.norm(pred_normalized - gt_normalized, axis=1)
-        mean_error = np.mean(errors)
-        nme = mean_error / eye_dist
-        
-        total_nme += nme
+        errors = np.linalg.norm(pred_normalized - gt_normalized, axis=2)
+        nme_values.append(errors.mean(axis=1) / eye_dist)
+        pred_all.append(pred_normalized)
+    
+    nme_values = np.concatenate(nme_values)
+    pred_all = np.concatenate(pred_all)
+    
+    for img_file, nme, pred_normalized in zip(dataset.image_files, nme_values, pred_all):
         print(f"{img_file}: NME = {nme:.6f}")
+        
+        if save_vis:
+            img_path = os.path.join(image_dir, img_file)
+            # Open once and reuse the decoded image for both the size and the drawing
+            image = Image.open(img_path).convert('RGB')
+            pred_landmarks = pred_normalized * np.array(image.size, dtype=np.float32)
+            vis_path = img_path.replace('.png', '_landmarks.png')
+            visualize_landmarks(image, pred_landmarks, vis_path)
     
-    avg_nme = total_nme / len(image_files)
+    avg_nme = nme_values.mean()
     print(f"\nAverage NME: {avg_nme:.6f}")
     
     return avg_nme
@@ -156,23 +223,21 @@ def main():
     print(f"Using device: {device}")
     
     # Load model
-    model = CatLandmarkModel(num_landmarks=48, backbone=args.backbone, pretrained=False)
-    
     if os.path.exists(args.model):
-        checkpoint = torch.load(args.model, map_location=device)
-        model.load_state_dict(checkpoint['model_state_dict'])
+        model = load_cat_model(args.model, str(device), args.backbone)
+        checkpoint = load_checkpoint(args.model, str(device))
         print(f"Loaded model from {args.model}")
         if 'val_loss' in checkpoint:
             print(f"Model val_loss: {checkpoint['val_loss']:.6f}")
     else:
         print(f"Warning: Model file {args.model} not found. Using untrained model.")
+        model = CatLandmarkModel(num_landmarks=48, backbone=args.backbone, pretrained=False)
     
-    model = model.to(device)
-    model.eval()
+    model = prepare_for_inference(model, device)
     
     # Predict on single image or evaluate on test set
     if args.image:
-        landmarks, landmarks_norm = predict_landmarks(model, args.image, device, save_vis=True)
+        landmarks = predict_landmarks(model, args.image, device, save_vis=True).landmarks
         print(f"\nPredicted {len(landmarks)} landmarks")
         print(f"Landmark coordinates (pixels):")
         for i, (x, y) in enumerate(landmarks):
@@ -6,12 +6,14 @@ import torchvision.models as models
 class CatLandmarkModel(nn.Module):
     """CNN-based model for cat facial landmark detection"""
     
-    def __init__(self, num_landmarks=48, backbone='resnet18', pretrained=True):
+    def __init__(self, num_landmarks=48, backbone='resnet18', pretrained=True, head='mlp'):
         """
         Args:
             num_landmarks: Number of facial landmarks (48 for CatFLW dataset)
             backbone: Backbone architecture ('resnet18', 'resnet34', 'resnet50')
             pretrained: Whether to use pretrained weights
+            head: Regression head, 'mlp' (3 Linear layers, matches existing checkpoints)
+                or 'linear' (a single Linear layer, one GEMM per forward; needs retraining)
         """
         super(CatLandmarkModel, self).__init__()
         self.num_landmarks = num_landmarks
@@ -48,16 +50,23 @@ class CatLandmarkModel(nn.Module):
         
         # Regression head for landmark prediction
         # Output: 2 * num_landmarks (x, y coordinates for each landmark)
-        self.fc = nn.Sequential(
-            nn.Linear(num_features, 512),
-            nn.ReLU(inplace=True),
-            nn.Dropout(0.3),  # Reduced dropout
-            nn.Linear(512, 256),
-            nn.ReLU(inplace=True),
-            nn.Dropout(0.3),  # Reduced dropout
-            nn.Linear(256, num_landmarks * 2),
-            nn.Sigmoid()  # Constrain outputs to [0, 1] range
-        )
+        # The final sigmoid is applied in forward() in float32 (see below)
+        if head == 'mlp':
+            self.fc = nn.Sequential(
+                nn.Linear(num_features, 512),
+                nn.ReLU(inplace=True),
+                nn.Dropout(0.3),  # Reduced dropout
+                nn.Linear(512, 256),
+                nn.ReLU(inplace=True),
+                nn.Dropout(0.3),  # Reduced dropout
+                nn.Linear(256, num_landmarks * 2),
+            )
+        elif head == 'linear':
+            self.fc = nn.Sequential(
+                nn.Linear(num_features, num_landmarks * 2),
+            )
+        else:
+            raise ValueError(f"Unsupported head: {head}")
         
     def forward(self, x):
         # Extract features
@@ -65,8 +74,26 @@ class CatLandmarkModel(nn.Module):
         x = self.avgpool(x)
         x = self.flatten(x)
         
-        # Predict landmarks
-        landmarks = self.fc(x)
+        # Predict landmarks, constrained to [0, 1]
+        # Sigmoid runs in float32 so fp16 inference doesn't saturate at the tails
+        landmarks = torch.sigmoid(self.fc(x).float())
         
         return landmarks
 
+
+class ImageNetNormalize(nn.Module):
+    """
+    Convert a uint8 image batch to float and apply ImageNet mean/std normalization
+    
+    Meant to run on the model's device, so only uint8 pixels cross the host-to-device
+    copy (4x fewer bytes than float32) and the CPU skips the per-pixel Normalize.
+    """
+    
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(ImageNetNormalize, self).__init__()
+        self.register_buffer('mean', torch.tensor(mean).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(std).view(1, 3, 1, 1))
+    
+    def forward(self, x):
+        # x.float() allocates the output once, the rest happens in place
+        return x.float().div_(255.0).sub_(self.mean).div_(self.std)
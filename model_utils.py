@@ -0,0 +1,41 @@
+import functools
+
+import torch
+
+from model import CatLandmarkModel
+
+
+@functools.lru_cache(maxsize=4)
+def load_checkpoint(model_path, device_str='cpu'):
+    """
+    Load a training checkpoint dict with weights_only=True (no arbitrary pickled code)
+    
+    Cached per (model_path, device), so scripts imported together read the file once.
+    The returned dict is shared between callers: read from it, don't modify it.
+    """
+    return torch.load(model_path, map_location=torch.device(device_str), weights_only=True)
+
+
+def load_cat_model(model_path, device_str='cpu', backbone='resnet18', head=None):
+    """
+    Load a trained CatLandmarkModel checkpoint in eval mode
+    
+    The checkpoint is read once per (model_path, device) through load_checkpoint, but
+    every call returns a new module with the weights copied in, so callers can convert
+    (.half(), channels_last) or compile their model without affecting anyone else's.
+    
+    Args:
+        model_path: Path to PyTorch checkpoint (.pth file)
+        device_str: Device to load the model onto ('cpu', 'cuda', ...)
+        backbone: Model backbone architecture
+        head: Regression head ('mlp' or 'linear'); default reads it from the checkpoint,
+            falling back to 'mlp' for checkpoints saved before the option existed
+    """
+    checkpoint = load_checkpoint(model_path, device_str)
+    if head is None:
+        head = checkpoint.get('head', 'mlp')
+    model = CatLandmarkModel(num_landmarks=48, backbone=backbone, pretrained=False, head=head)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model.to(torch.device(device_str))
+    model.eval()
+    return model
@@ -1,15 +1,90 @@
-from model import CatLandmarkModel
-from inference import predict_landmarks
+from model import CatLandmarkModel, ImageNetNormalize
+from model_utils import load_cat_model, load_checkpoint
+from inference import LandmarkPrediction, predict_landmarks, prepare_for_inference, load_image_tensor, visualize_landmarks
 import numpy as np
 import torch
 import os
+import functools
+
+# Set USE_ORT=1 to run landmark prediction through ONNX Runtime (see export_model.py)
+USE_ORT = os.environ.get('USE_ORT', '0') == '1'
+
+# CPU-only normalization for the ONNX Runtime inputs, never moved to another device
+_ort_normalize = ImageNetNormalize()
+
+
+@functools.lru_cache(maxsize=2)
+def _get_ort_session(onnx_path):
+    """Create the ONNX Runtime session once per model file"""
+    import onnxruntime as ort
+    providers = [p for p in ['CUDAExecutionProvider', 'CPUExecutionProvider'] if p in ort.get_available_providers()]
+    return ort.InferenceSession(onnx_path, providers=providers)
+
+
+@functools.lru_cache(maxsize=2)
+def _load_model(model_path, device):
+    """Load the checkpoint once per (model_path, device) and prepare it for inference"""
+    if os.path.exists(model_path):
+        # load_cat_model returns a module of our own, so converting it in place is safe
+        model = load_cat_model(model_path, str(device))
+        checkpoint = load_checkpoint(model_path, str(device))
+        print(f"Loaded model from {model_path}")
+        if 'val_loss' in checkpoint:
+            print(f"Model val_loss: {checkpoint['val_loss']:.6f}")
+    else:
+        print(f"Warning: Model file {model_path} not found. Using untrained model.")
+        model = CatLandmarkModel(num_landmarks=48, backbone="resnet18", pretrained=False)
+    
+    return prepare_for_inference(model, device)
+
+
+def predict_landmarks_ort(onnx_path, image_path):
+    """Same outputs as inference.predict_landmarks, using ONNX Runtime instead of PyTorch"""
+    session = _get_ort_session(onnx_path)
+    img_tensor, image = load_image_tensor(image_path)
+    original_size = image.size
+    img = _ort_normalize(img_tensor.unsqueeze(0)).numpy()
+    
+    predictions = session.run(None, {'input': img})[0]
+    landmarks_normalized = predictions.reshape(48, 2)
+    landmarks = landmarks_normalized * np.array(original_size, dtype=np.float32)
+    
+    return LandmarkPrediction(landmarks, landmarks_normalized, visualize_landmarks(image, landmarks), original_size)
+
+
+# (from, to) landmark index pairs for each measurement, so every function
+# gathers its vectors with one fancy-index instead of one norm/dot per pair
+# Eyes: left horizontal, left vertical, right horizontal, right vertical
+EYE_PAIRS = np.array([[9, 8], [10, 11], [5, 4], [7, 6]])
+# Ears: angle between vectors A and B for right ear, left ear, left vertical, right vertical
+EAR_A_PAIRS = np.array([[25, 26], [28, 27], [31, 22], [31, 22]])
+EAR_B_PAIRS = np.array([[27, 26], [26, 27], [31, 30], [22, 23]])
+# Muzzle: left width, right width, left height, right height
+MUZZLE_PAIRS = np.array([[44, 32], [45, 35], [42, 21], [43, 19]])
+
+
+def _pair_vectors(landmarks, pairs):
+    """Difference vectors landmarks[from] - landmarks[to], shape (k, 2)"""
+    return landmarks[pairs[:, 0]] - landmarks[pairs[:, 1]]
+
+
+def _pair_distances(landmarks, pairs):
+    v = _pair_vectors(landmarks, pairs)
+    return np.sqrt((v * v).sum(1))
+
+
+def _pair_angles(landmarks, a_pairs, b_pairs):
+    """Angles in degrees between the A and B difference vectors of each row"""
+    a = _pair_vectors(landmarks, a_pairs)
+    b = _pair_vectors(landmarks, b_pairs)
+    cos = (a * b).sum(1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return np.degrees(np.arccos(cos))
+
 
 def eyes(landmarks):
     # Calculate vertical vs horizontal distance between eyelids
-    left_eye_horizontal_distance = np.linalg.norm(landmarks[9] - landmarks[8])
-    left_eye_vertical_distance = np.linalg.norm(landmarks[10] - landmarks[11])
-    right_eye_horizontal_distance = np.linalg.norm(landmarks[5] - landmarks[4])
-    right_eye_vertical_distance = np.linalg.norm(landmarks[7] - landmarks[6])
+    (left_eye_horizontal_distance, left_eye_vertical_distance,
+     right_eye_horizontal_distance, right_eye_vertical_distance) = _pair_distances(landmarks, EYE_PAIRS)
     print(f"Left eye horizontal distance: {left_eye_horizontal_distance}, Left eye vertical distance: {left_eye_vertical_distance}")
     print(f"Right eye horizontal distance: {right_eye_horizontal_distance}, Right eye vertical distance: {right_eye_vertical_distance}")
     r_ratio = right_eye_vertical_distance / right_eye_horizontal_distance
@@ -21,24 +96,8 @@ def eyes(landmarks):
 
 def ears(landmarks):
     # Calculate angle of ears
-    r_ear_a = landmarks[25] - landmarks[26]
-    r_ear_b = landmarks[27] - landmarks[26]
-    r_cosine_angle = np.dot(r_ear_a, r_ear_b) / (np.linalg.norm(r_ear_a) * np.linalg.norm(r_ear_b))
-    r_ear_angle = np.degrees(np.arccos(r_cosine_angle))
-    
-    l_ear_a = landmarks[28] - landmarks[27]
-    l_ear_b = landmarks[26] - landmarks[27]
-    l_cosine_angle = np.dot(l_ear_a, l_ear_b) / (np.linalg.norm(l_ear_a) * np.linalg.norm(l_ear_b))
-    l_ear_angle = np.degrees(np.arccos(l_cosine_angle))
+    r_ear_angle, l_ear_angle, l_vert_angle, r_vert_angle = _pair_angles(landmarks, EAR_A_PAIRS, EAR_B_PAIRS)
     print(f"Right ear angle: {r_ear_angle}, Left ear angle: {l_ear_angle}")
-    
-    ear_base_line = landmarks[31] - landmarks[22]
-    l_ear_vertical = landmarks[31] - landmarks[30]
-    r_ear_vertical = landmarks[22] - landmarks[23]
-    l_vert_cosine_angle = np.dot(ear_base_line, l_ear_vertical) / (np.linalg.norm(ear_base_line) * np.linalg.norm(l_ear_vertical))
-    r_vert_cosine_angle = np.dot(ear_base_line, r_ear_vertical) / (np.linalg.norm(ear_base_line) * np.linalg.norm(r_ear_vertical))
-    l_vert_angle = np.degrees(np.arccos(l_vert_cosine_angle))
-    r_vert_angle = np.degrees(np.arccos(r_vert_cosine_angle))
     print(f"Right ear vertical angle: {r_vert_angle}, Left ear vertical angle: {l_vert_angle}")
 
     min_ear_ang = min(l_ear_angle, r_ear_angle)
@@ -50,10 +109,7 @@ def ears(landmarks):
     return 1
 
 def muzzle(landmarks):
-    l_muzzle_width = np.linalg.norm(landmarks[44] - landmarks[32])
-    r_muzzle_width = np.linalg.norm(landmarks[45] - landmarks[35])
-    l_muzzle_height = np.linalg.norm(landmarks[42] - landmarks[21])
-    r_muzzle_height = np.linalg.norm(landmarks[43] - landmarks[19])
+    l_muzzle_width, r_muzzle_width, l_muzzle_height, r_muzzle_height = _pair_distances(landmarks, MUZZLE_PAIRS)
     l_muzzle_ratio = l_muzzle_width / l_muzzle_height
     r_muzzle_ratio = r_muzzle_width / r_muzzle_height
     print(f"Right muzzle ratio: {r_muzzle_ratio}, Left muzzle ratio: {l_muzzle_ratio}")
@@ -63,7 +119,8 @@ def muzzle(landmarks):
     return 0
 
 
-def calculate_pain_score(image_path, model_path='checkpoints/best_model.pth', num_mc_samples=10):
+def calculate_pain_score(image_path, model_path='checkpoints/best_model.pth', num_mc_samples=10,
+                         use_ort=USE_ORT, onnx_path='cat_landmarks.onnx'):
     """
     Calculate pain score based on landmark positions
     
@@ -76,26 +133,17 @@ def calculate_pain_score(image_path, model_path='checkpoints/best_model.pth', nu
         ears: angle of ears
     """
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')    
-    # Load model
-    model = CatLandmarkModel(num_landmarks=48, backbone="resnet18", pretrained=False)
-    
-    if os.path.exists(model_path):
-        checkpoint = torch.load(model_path, map_location=device)
-        model.load_state_dict(checkpoint['model_state_dict'])
-        print(f"Loaded model from {model_path}")
-        if 'val_loss' in checkpoint:
-            print(f"Model val_loss: {checkpoint['val_loss']:.6f}")
+    if use_ort and os.path.exists(onnx_path):
+        landmarks, landmarks_norm, image, _ = predict_landmarks_ort(onnx_path, image_path)
     else:
-        print(f"Warning: Model file {model_path} not found. Using untrained model.")
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        model = _load_model(model_path, device)
+        
+        # Predict on single image or evaluate on test set
+        landmarks, landmarks_norm, image, _ = predict_landmarks(
+            model, image_path, device, save_vis=False
+        )
     
-    model = model.to(device)
-    model.eval()
-    
-    # Predict on single image or evaluate on test set
-    landmarks, landmarks_norm, plt = predict_landmarks(
-        model, image_path, device, save_vis=False
-    )
     print(f"\nPredicted {len(landmarks)} landmarks")
     print(f"\nConfidence Scores:")
     print(f"\nLandmark coordinates (pixels):")
@@ -107,17 +155,15 @@ def calculate_pain_score(image_path, model_path='checkpoints/best_model.pth', nu
     muzzle_score = muzzle(landmarks)
     print(f'eye score: {eye_score}, ears_score: {ears_score}, muzzle_score: {muzzle_score}')
 
-    plt.show()
+    image.show()
 
     if eye_score == -1 or ears_score == -1 or muzzle_score == -1:
         print('ERROR')
-    
-
-
 
 
-calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/noonoo.jpg")
-# calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/pain.jpg")
-calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/piggy.jpeg")
+if __name__ == "__main__":
+    calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/noonoo.jpg")
+    # calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/pain.jpg")
+    calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/piggy.jpeg")
 
-# calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/CAT_01_00000142_006.png")
\ No newline at end of file
+    # calculate_pain_score("/Users/elaine01px2019/Downloads/CatFLW dataset/images/CAT_01_00000142_006.png")
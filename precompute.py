@@ -0,0 +1,66 @@
+"""
+Pre-decode the CatFLW dataset into memory-mapped NumPy arrays for CachedCatLandmarkDataset
+
+Usage:
+    python precompute.py --data_dir "CatFLW dataset" --output cache
+
+Writes:
+    images.npy      (N, 224, 224, 3) uint8 RGB, already resized
+    landmarks.npy   (N, 96) float32, normalized by the original image size
+    image_files.txt one filename per line, in the same order
+"""
+
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from dataset import CatLandmarkDataset, load_landmarks
+
+
+def precompute(data_dir, output_dir, img_size=(224, 224)):
+    """Decode, resize and stack every image and label into .npy files"""
+    image_dir = os.path.join(data_dir, 'images')
+    label_dir = os.path.join(data_dir, 'labels')
+    
+    # Reuse the dataset's file listing so indices match CatLandmarkDataset
+    image_files = CatLandmarkDataset(image_dir, label_dir).image_files
+    num_images = len(image_files)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    images = np.lib.format.open_memmap(os.path.join(output_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(num_images, img_size[1], img_size[0], 3))
+    landmarks = np.lib.format.open_memmap(os.path.join(output_dir, 'landmarks.npy'), mode='w+',
+                                          dtype=np.float32, shape=(num_images, 96))
+    
+    for i, img_file in enumerate(tqdm(image_files, desc='Precomputing')):
+        image = Image.open(os.path.join(image_dir, img_file)).convert('RGB')
+        original_size = image.size
+        images[i] = np.asarray(image.resize(img_size, Image.BILINEAR), dtype=np.uint8)
+        
+        gt_landmarks = load_landmarks(os.path.join(label_dir, img_file.replace('.png', '.json')))
+        landmarks[i] = (gt_landmarks / np.array(original_size, dtype=np.float32)).reshape(-1)
+    
+    images.flush()
+    landmarks.flush()
+    
+    with open(os.path.join(output_dir, 'image_files.txt'), 'w') as f:
+        f.write('\n'.join(image_files) + '\n')
+    
+    print(f"Saved {num_images} samples to {output_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-decode CatFLW images and labels into .npy files')
+    parser.add_argument('--data_dir', type=str, default='/Users/elaine01px2019/Downloads/CatFLW dataset',
+                        help='Dataset directory containing images/ and labels/')
+    parser.add_argument('--output', type=str, default='cache', help='Output directory for the .npy files')
+    
+    args = parser.parse_args()
+    precompute(args.data_dir, args.output)
+
+
+if __name__ == '__main__':
+    main()
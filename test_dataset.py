@@ -0,0 +1,76 @@
+"""
+Checks the image dtype contract of the datasets: tensor paths return uint8 (3, H, W),
+which ImageNetNormalize converts to float on the device
+
+Run with: python -m pytest test_dataset.py
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from dataset import CatLandmarkDataset, CachedCatLandmarkDataset
+
+
+def make_sample_dir(root, size=(40, 30)):
+    """Write one PNG image and its JSON label in the CatFLW layout"""
+    image_dir = os.path.join(root, 'images')
+    label_dir = os.path.join(root, 'labels')
+    os.makedirs(image_dir)
+    os.makedirs(label_dir)
+    Image.new('RGB', size, color=(200, 100, 50)).save(os.path.join(image_dir, 'cat.png'))
+    with open(os.path.join(label_dir, 'cat.json'), 'w') as f:
+        json.dump({'labels': [[10.0, 15.0]] * 48}, f)
+    return image_dir, label_dir
+
+
+def test_tensor_decode_returns_uint8(tmp_path):
+    image_dir, label_dir = make_sample_dir(str(tmp_path))
+    dataset = CatLandmarkDataset(image_dir, label_dir, tensor_decode=True)
+
+    image, landmarks = dataset[0]
+    assert image.dtype == torch.uint8
+    assert image.shape == (3, 30, 40)
+    assert int(image[0, 0, 0]) == 200
+    assert landmarks.shape == (96,)
+    assert torch.allclose(landmarks[:2], torch.tensor([10.0 / 40, 15.0 / 30]))
+
+
+def test_pil_decode_returns_float(tmp_path):
+    image_dir, label_dir = make_sample_dir(str(tmp_path))
+    dataset = CatLandmarkDataset(image_dir, label_dir)
+
+    image, _ = dataset[0]
+    assert image.dtype == torch.float32
+    assert image.shape == (3, 30, 40)
+    assert float(image.max()) <= 1.0
+
+
+def test_cached_dataset_returns_uint8(tmp_path):
+    cache_dir = str(tmp_path)
+    np.save(os.path.join(cache_dir, 'images.npy'), np.full((2, 8, 8, 3), 7, dtype=np.uint8))
+    np.save(os.path.join(cache_dir, 'landmarks.npy'), np.zeros((2, 96), dtype=np.float32))
+    with open(os.path.join(cache_dir, 'image_files.txt'), 'w') as f:
+        f.write('a.png\nb.png\n')
+    dataset = CachedCatLandmarkDataset(cache_dir)
+
+    image, landmarks = dataset[1]
+    assert image.dtype == torch.uint8
+    assert image.shape == (3, 8, 8)
+    assert int(image[0, 0, 0]) == 7
+    assert landmarks.shape == (96,)
+
+
+def test_cached_dataset_rejects_mismatched_filenames(tmp_path):
+    cache_dir = str(tmp_path)
+    np.save(os.path.join(cache_dir, 'images.npy'), np.zeros((2, 8, 8, 3), dtype=np.uint8))
+    np.save(os.path.join(cache_dir, 'landmarks.npy'), np.zeros((2, 96), dtype=np.float32))
+    with open(os.path.join(cache_dir, 'image_files.txt'), 'w') as f:
+        f.write('a.png\n')
+
+    with pytest.raises(ValueError, match='precompute.py'):
+        CachedCatLandmarkDataset(cache_dir)
@@ -5,7 +5,8 @@ Test script to verify preprocessing matches between PyTorch and what we're doing
 import torch
 import numpy as np
 from PIL import Image
-from torchvision import transforms
+
+from inference import DEFAULT_TRANSFORM, get_normalize
 
 # Create a test image (or use a real one)
 # For testing, create a simple colored image
@@ -16,14 +17,8 @@ test_image = Image.new('RGB', (300, 400), color='red')
 original_size = test_image.size
 print(f"Original image size: {original_size}")
 
-# PyTorch preprocessing (exactly as in inference.py)
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-])
-
-img_tensor = transform(test_image)
+# PyTorch preprocessing (the same transform and normalization inference.py uses)
+img_tensor = get_normalize(torch.device('cpu'))(DEFAULT_TRANSFORM(test_image).unsqueeze(0))[0]
 print(f"\nTensor shape: {img_tensor.shape}")  # Should be [3, 224, 224]
 print(f"Tensor dtype: {img_tensor.dtype}")
 
@@ -1,80 +1,160 @@
 import os
+import contextlib
+import threading
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, random_split, Subset
-from torchvision import transforms
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import random_split
+from torch.utils.data.distributed import DistributedSampler
+from torchvision.transforms import v2
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import numpy as np
 
-from dataset import CatLandmarkDataset
-from model import CatLandmarkModel
+from dataset import CatLandmarkDataset, CachedCatLandmarkDataset, TransformSubset, build_loader
+from model import CatLandmarkModel, ImageNetNormalize
 
 
-def train_epoch(model, dataloader, criterion, optimizer, device):
-    """Train for one epoch"""
+def is_main_process():
+    """True unless running distributed on a rank other than 0"""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def to_cpu(obj):
+    """Recursively copy the tensors in a (nested) state dict to the CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def save_async(state, path, previous=None):
+    """
+    Snapshot state to the CPU and torch.save it on a background thread
+    
+    Training continues while the file is written. Waits for the previous save
+    (if any) first so writes never overlap. Returns the thread to pass as previous
+    next time, and to join() before exiting.
+    """
+    state = to_cpu(state)
+    if previous is not None:
+        previous.join()
+    thread = threading.Thread(target=torch.save, args=(state, path))
+    thread.start()
+    return thread
+
+
+def train_epoch(model, dataloader, criterion, optimizer, device, normalize, accum_steps=1, ddp_model=None):
+    """
+    Train for one epoch
+    
+    Args:
+        normalize: Converts the uint8 image batch to normalized float on the device
+        accum_steps: Mini-batches whose gradients are accumulated per optimizer step
+        ddp_model: The DistributedDataParallel module when training distributed, so
+            gradients are only all-reduced on the micro-batch that steps the optimizer
+    """
     model.train()
-    running_loss = 0.0
+    # Accumulated on the device so the loop never blocks on a GPU -> CPU sync
+    running_loss = torch.zeros((), device=device)
+    num_batches = len(dataloader)
+    optimizer.zero_grad(set_to_none=True)
     
-    for images, landmarks in tqdm(dataloader, desc='Training'):
-        images = images.to(device)
-        landmarks = landmarks.to(device)
+    for i, (images, landmarks) in enumerate(tqdm(dataloader, desc='Training', disable=not is_main_process())):
+        # build_loader pins batches on CUDA, so these copies run asynchronously
+        images = images.to(device, memory_format=torch.channels_last, non_blocking=True)
+        landmarks = landmarks.to(device, non_blocking=True)
+        images = normalize(images)
         
-        # Forward pass
-        optimizer.zero_grad()
-        predictions = model(images)
+        # Batches in this accumulation window (the last window of the epoch may be shorter)
+        window_len = min(accum_steps, num_batches - (i - i % accum_steps))
+        step = (i + 1) % accum_steps == 0 or i + 1 == num_batches
+        sync = ddp_model.no_sync() if ddp_model is not None and not step else contextlib.nullcontext()
         
-        # Calculate loss
-        loss = criterion(predictions, landmarks)
+        with sync:
+            # Forward pass in bf16 on CUDA (same exponent range as fp32, so no GradScaler needed)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+                predictions = model(images)
+                
+                # Calculate loss
+                loss = criterion(predictions, landmarks)
+            
+            # Backward pass, scaled so the accumulated gradient is the mean over the window
+            (loss / window_len).backward()
         
-        # Backward pass
-        loss.backward()
-        optimizer.step()
+        if step:
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
         
-        running_loss += loss.item()
+        running_loss += loss.detach()
     
-    return running_loss / len(dataloader)
+    avg_loss = running_loss / num_batches
+    if dist.is_initialized():
+        # Average the per-rank losses
+        dist.all_reduce(avg_loss)
+        avg_loss /= dist.get_world_size()
+    
+    return avg_loss.item()
 
 
-def validate(model, dataloader, criterion, device):
+def validate(model, dataloader, criterion, device, normalize):
     """Validate the model"""
     model.eval()
-    running_loss = 0.0
-    running_nme = 0.0  # Normalized Mean Error
+    # Accumulated on the device and read back once at the end, so the loop never
+    # blocks on a GPU -> CPU sync; sums over samples so a short last batch isn't over-weighted
+    running_loss = torch.zeros((), device=device)
+    running_nme = torch.zeros((), device=device)  # Normalized Mean Error
+    num_samples = 0
+    # Eye corner landmarks used for the inter-ocular distance, gathered with one index_select
+    eye_idx = torch.tensor([8, 11], device=device)
     
-    with torch.no_grad():
-        for images, landmarks in tqdm(dataloader, desc='Validating'):
-            images = images.to(device)
-            landmarks = landmarks.to(device)
+    with torch.inference_mode():
+        for images, landmarks in tqdm(dataloader, desc='Validating', disable=not is_main_process()):
+            images = images.to(device, memory_format=torch.channels_last, non_blocking=True)
+            landmarks = landmarks.to(device, non_blocking=True)
+            images = normalize(images)
             
             # Forward pass
-            predictions = model(images)
-            
-            # Calculate loss
-            loss = criterion(predictions, landmarks)
-            running_loss += loss.item()
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+                predictions = model(images)
+                
+                # Calculate loss
+                loss = criterion(predictions, landmarks)
+            running_loss += loss.detach() * images.size(0)
+            num_samples += images.size(0)
             
-            # Calculate NME (Normalized Mean Error)
+            # Calculate NME (Normalized Mean Error) in float32, the eye distance is small
             # Reshape to (batch, num_landmarks, 2)
-            pred_landmarks = predictions.view(-1, 48, 2)
+            pred_landmarks = predictions.float().view(-1, 48, 2)
             gt_landmarks = landmarks.view(-1, 48, 2)
             
             # Calculate inter-ocular distance as normalization factor
             # Using eye corners (indices 8 and 11 as approximate)
-            eye_dist_pred = torch.norm(pred_landmarks[:, 8, :] - pred_landmarks[:, 11, :], dim=1)
-            eye_dist_gt = torch.norm(gt_landmarks[:, 8, :] - gt_landmarks[:, 11, :], dim=1)
-            eye_dist = torch.clamp(eye_dist_gt, min=1e-5)  # Avoid division by zero
+            # Written as sub -> square -> sum -> sqrt so torch.compile can fuse each into one kernel;
+            # clamping the squared distance at 1e-10 == clamping the distance at 1e-5
+            eye_pts = gt_landmarks.index_select(1, eye_idx)  # (batch, 2, 2), contiguous
+            eye_dist = (eye_pts[:, 0] - eye_pts[:, 1]).pow(2).sum(-1).clamp_min(1e-10).sqrt()
             
             # Calculate mean error per sample
-            errors = torch.norm(pred_landmarks - gt_landmarks, dim=2)  # Shape: (batch, 47)
+            errors = (pred_landmarks - gt_landmarks).pow(2).sum(-1).sqrt()  # Shape: (batch, 48)
             mean_errors = torch.mean(errors, dim=1)  # Shape: (batch,)
             nme_per_sample = mean_errors / eye_dist
             
-            running_nme += nme_per_sample.mean().item()
+            running_nme += nme_per_sample.sum()
     
-    avg_loss = running_loss / len(dataloader)
-    avg_nme = running_nme / len(dataloader)
+    if dist.is_initialized():
+        # Sum over every rank's shard of the validation set
+        totals = torch.stack([running_loss, running_nme, torch.tensor(float(num_samples), device=device)])
+        dist.all_reduce(totals)
+        running_loss, running_nme, num_samples = totals
+    
+    avg_loss = (running_loss / num_samples).item()
+    avg_nme = (running_nme / num_samples).item()
     
     return avg_loss, avg_nme
 
@@ -83,106 +163,169 @@ def main():
     # Configuration
     config = {
         'data_dir': '/Users/elaine01px2019/Downloads/CatFLW dataset',
+        'cache_dir': None,  # Output of precompute.py; if set, train from the memmapped cache instead of decoding
         'batch_size': 32,
         'num_epochs': 50,  # Increased for better training
         'learning_rate': 0.0001,  # Lower learning rate for better convergence
+        'accum_steps': 2,  # Gradient accumulation, effective batch size = batch_size * accum_steps
         'val_split': 0.2,
-        'num_workers': 2,  # Reduced for stability
+        'num_workers': min(8, os.cpu_count() or 1),  # Decode + augmentation is CPU-bound
+        'prefetch_factor': 4,  # Batches queued per worker, capped to limit pinned memory
         'backbone': 'resnet18',
+        'head': 'mlp',  # 'linear' is a cheaper single-layer head
         'pretrained': True,
+        'compile': True,  # torch.compile the model on CUDA
         'save_dir': 'checkpoints',
         'log_dir': 'logs',
     }
     
-    # Set device
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"Using device: {device}")
+    # Set device. When launched with torchrun (e.g. torchrun --nproc_per_node=4 train.py)
+    # each process trains on its own GPU with DistributedDataParallel
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        local_rank = int(os.environ['LOCAL_RANK'])
+        dist.init_process_group('nccl')
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    is_main = is_main_process()
+    if is_main:
+        print(f"Using device: {device}" + (f" x {dist.get_world_size()} processes" if distributed else ""))
+    
+    # Input shape is fixed at 224x224, so let cuDNN benchmark and cache the fastest conv algorithms
+    torch.backends.cudnn.benchmark = True
+    
+    # Allow TF32 for the float32 matmuls/convs that run outside bf16 autocast (Ampere+)
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     
     # Create directories
     os.makedirs(config['save_dir'], exist_ok=True)
     os.makedirs(config['log_dir'], exist_ok=True)
     
-    # Data transforms
-    train_transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ColorJitter(brightness=0.2, contrast=0.2),
-        transforms.RandomHorizontalFlip(p=0.5),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    # Data transforms - images are decoded by torchvision.io straight into uint8 tensors and
+    # stay uint8 through the v2 transforms; ImageNet normalization runs once per batch on the
+    # device (4x smaller host-to-device copies, no per-pixel CPU work).
+    # Cached images are already 224x224, so they skip the Resize
+    resize = [] if config['cache_dir'] else [v2.Resize((224, 224), antialias=True)]
+    train_transform = v2.Compose(resize + [
+        v2.ColorJitter(brightness=0.2, contrast=0.2),
+        v2.RandomHorizontalFlip(p=0.5),
     ])
     
-    val_transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
+    val_transform = v2.Compose(resize) if resize else None
+    normalize = ImageNetNormalize().to(device)
     
     # Create dataset
     image_dir = os.path.join(config['data_dir'], 'images')
     label_dir = os.path.join(config['data_dir'], 'labels')
     
-    # Create full dataset without transform for splitting
-    full_dataset = CatLandmarkDataset(image_dir, label_dir, transform=None)
+    # Create the full dataset once (one directory scan) and split its indices. precompute.py
+    # stores samples in CatLandmarkDataset order, so both give the same split
+    if config['cache_dir']:
+        full_dataset = CachedCatLandmarkDataset(config['cache_dir'])
+        # A cache built from an older data_dir would give a different split than check_train_split.py
+        if full_dataset.image_files != CatLandmarkDataset(image_dir, label_dir).image_files:
+            raise ValueError(f"Cache in {config['cache_dir']} does not match the images in {image_dir}; "
+                             f"rerun precompute.py")
+    else:
+        full_dataset = CatLandmarkDataset(image_dir, label_dir, transform=None, tensor_decode=True)
     
     # Split dataset indices
     val_size = int(len(full_dataset) * config['val_split'])
     train_size = len(full_dataset) - val_size
-    train_split, val_split = random_split(full_dataset, [train_size, val_size])
+    # Fixed seed so every process (and check_train_split.py) gets the same split
+    train_split, val_split = random_split(range(len(full_dataset)), [train_size, val_size],
+                                          generator=torch.Generator().manual_seed(42))
     
-    # Create separate datasets with appropriate transforms
-    train_dataset_full = CatLandmarkDataset(image_dir, label_dir, transform=train_transform)
-    val_dataset_full = CatLandmarkDataset(image_dir, label_dir, transform=val_transform)
+    # Create subsets with the split indices, each with its own transform
+    train_dataset = TransformSubset(full_dataset, train_split.indices, train_transform)
+    val_indices = val_split.indices
+    if distributed:
+        # Strided shards without padding (DistributedSampler would repeat samples to even
+        # out the shards and bias the metrics); validate() all-reduces the sample counts
+        val_indices = val_indices[dist.get_rank()::dist.get_world_size()]
+    val_dataset = TransformSubset(full_dataset, val_indices, val_transform)
     
-    # Create subsets with the split indices
-    train_dataset = Subset(train_dataset_full, train_split.indices)
-    val_dataset = Subset(val_dataset_full, val_split.indices)
+    # Distributed runs give each process its own shard; the sampler does the shuffling
+    train_sampler = DistributedSampler(train_dataset) if distributed else None
     
     # Create data loaders
-    train_loader = DataLoader(
+    train_loader = build_loader(
         train_dataset,
         batch_size=config['batch_size'],
-        shuffle=True,
         num_workers=config['num_workers'],
-        pin_memory=True if torch.cuda.is_available() else False
+        prefetch_factor=config['prefetch_factor'],
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
+        drop_last=True  # Keep every train batch the same shape so the compiled graph is reused
     )
     
-    val_loader = DataLoader(
+    val_loader = build_loader(
         val_dataset,
         batch_size=config['batch_size'],
-        shuffle=False,
         num_workers=config['num_workers'],
-        pin_memory=True if torch.cuda.is_available() else False
+        prefetch_factor=config['prefetch_factor'],
+        shuffle=False
     )
     
-    print(f"Train samples: {train_size}, Val samples: {val_size}")
+    if is_main:
+        print(f"Train samples: {train_size}, Val samples: {val_size}")
     
     # Create model
-    model = CatLandmarkModel(num_landmarks=48, backbone=config['backbone'], pretrained=config['pretrained'])
-    model = model.to(device)
+    model = CatLandmarkModel(num_landmarks=48, backbone=config['backbone'], pretrained=config['pretrained'],
+                             head=config['head'])
+    # channels_last (NHWC) lets cuDNN pick tensor-core conv kernels without transposes
+    model = model.to(device, memory_format=torch.channels_last)
+    
+    # Compile for fused kernels and CUDA graphs. The compiled wrapper shares parameters
+    # with model, which is still what gets checkpointed (its state_dict keys have no
+    # _orig_mod. prefix, so the inference scripts can load it)
+    ddp_model = DDP(model, device_ids=[local_rank]) if distributed else None
+    train_model = ddp_model if distributed else model
+    # Validation runs on the unwrapped model: the shards can differ in batch count, so it
+    # must not issue DDP collectives
+    val_model = model
+    # Compilation is lazy and happens on the first training step; set 'compile': False
+    # to train eagerly if it fails on this setup
+    if config['compile'] and device.type == 'cuda':
+        train_model = torch.compile(train_model, mode='reduce-overhead')
+        val_model = torch.compile(model, mode='reduce-overhead') if distributed else train_model
     
     # Loss function and optimizer
     criterion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=config['learning_rate'])
+    # fused=True updates every parameter tensor in a single CUDA kernel
+    optimizer = optim.Adam(model.parameters(), lr=config['learning_rate'], fused=device.type == 'cuda')
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=10)
     
-    # TensorBoard writer
-    writer = SummaryWriter(log_dir=config['log_dir'])
+    # TensorBoard writer (rank 0 only, like the prints and checkpoints below)
+    writer = SummaryWriter(log_dir=config['log_dir']) if is_main else None
     
     # Training loop
     best_val_loss = float('inf')
+    save_thread = None
     
     for epoch in range(config['num_epochs']):
-        print(f"\nEpoch {epoch+1}/{config['num_epochs']}")
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)  # Reshuffle the shards every epoch
+        if is_main:
+            print(f"\nEpoch {epoch+1}/{config['num_epochs']}")
         
         # Train
-        train_loss = train_epoch(model, train_loader, criterion, optimizer, device)
+        train_loss = train_epoch(train_model, train_loader, criterion, optimizer, device, normalize,
+                                 accum_steps=config['accum_steps'], ddp_model=ddp_model)
         
         # Validate
-        val_loss, val_nme = validate(model, val_loader, criterion, device)
+        val_loss, val_nme = validate(val_model, val_loader, criterion, device, normalize)
         
-        # Update learning rate
+        # Update learning rate (val_loss is already averaged over all ranks)
         scheduler.step(val_loss)
         
+        if not is_main:
+            continue
+        
         # Log to TensorBoard
         writer.add_scalar('Loss/Train', train_loss, epoch)
         writer.add_scalar('Loss/Validation', val_loss, epoch)
@@ -200,8 +343,9 @@ def main():
                 'optimizer_state_dict': optimizer.state_dict(),
                 'val_loss': val_loss,
                 'val_nme': val_nme,
+                'head': config['head'],
             }
-            torch.save(checkpoint, os.path.join(config['save_dir'], 'best_model.pth'))
+            save_thread = save_async(checkpoint, os.path.join(config['save_dir'], 'best_model.pth'), save_thread)
             print(f"Saved best model with val_loss: {val_loss:.6f}")
         
         # Save checkpoint every 10 epochs
@@ -212,11 +356,18 @@ def main():
                 'optimizer_state_dict': optimizer.state_dict(),
                 'val_loss': val_loss,
                 'val_nme': val_nme,
+                'head': config['head'],
             }
-            torch.save(checkpoint, os.path.join(config['save_dir'], f'checkpoint_epoch_{epoch+1}.pth'))
+            save_thread = save_async(checkpoint, os.path.join(config['save_dir'], f'checkpoint_epoch_{epoch+1}.pth'),
+                                     save_thread)
     
-    writer.close()
-    print("\nTraining completed!")
+    if save_thread is not None:
+        save_thread.join()  # Make sure the last checkpoint is fully written
+    if is_main:
+        writer.close()
+        print("\nTraining completed!")
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -16,11 +16,12 @@ full_dataset = CatLandmarkDataset(image_dir, label_dir, transform=None)
 val_split = 0.2
 val_size = int(len(full_dataset) * val_split)
 train_size = len(full_dataset) - val_size
-train_split, val_split_indices = random_split(full_dataset, [train_size, val_size])
+# Same seeded split over indices as train.py and check_train_split.py
+train_split, val_split_indices = random_split(range(len(full_dataset)), [train_size, val_size],
+                                              generator=torch.Generator().manual_seed(42))
 
-# Get all image files (sorted)
-all_image_files = sorted([f for f in os.listdir(image_dir) 
-                         if f.endswith('.png') and '_landmarks' not in f and '_comparison' not in f])
+# Get all image files (sorted, as listed by the dataset)
+all_image_files = full_dataset.image_files
 
 # Get filenames for validation set only
 val_indices = val_split_indices.indices
@@ -37,64 +38,65 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print(f"Using device: {device}\n")
 
 # Load model
-from model import CatLandmarkModel
-model = CatLandmarkModel(num_landmarks=48, backbone='resnet18', pretrained=False)
-checkpoint = torch.load('checkpoints/best_model.pth', map_location=device)
-model.load_state_dict(checkpoint['model_state_dict'])
-model.to(device)
-model.eval()
+from model_utils import load_cat_model, load_checkpoint
+model = load_cat_model('checkpoints/best_model.pth', str(device))
+checkpoint = load_checkpoint('checkpoints/best_model.pth', str(device))
 
 print(f"Loaded model from checkpoints/best_model.pth")
 print(f"Model val_loss: {checkpoint['val_loss']:.6f}\n")
 
 # Test on validation set images only
-from inference import predict_landmarks
-import json
+from concurrent.futures import ThreadPoolExecutor
+from inference import DEFAULT_TRANSFORM, predict_batch, visualize_landmarks
+from dataset import load_landmarks
 import numpy as np
 from PIL import Image
 
 test_files = val_files[:50]  # First 50 from validation set
 print(f"Testing on {len(test_files)} images from VALIDATION set only\n")
 
-total_nme = 0.0
-for img_file in test_files:
-    img_path = os.path.join(image_dir, img_file)
-    label_path = os.path.join(label_dir, img_file.replace('.png', '.json'))
-    
-    # Load ground truth
-    with open(label_path, 'r') as f:
-        gt_data = json.load(f)
-    gt_landmarks = np.array(gt_data['labels'], dtype=np.float32)
-    
-    # Predict
-    pred_landmarks, _ = predict_landmarks(model, img_path, device, save_vis=True)
-    
-    # Calculate NME
-    image = Image.open(img_path).convert('RGB')
-    img_width, img_height = image.size
-    
-    # Normalize GT landmarks
-    gt_normalized = gt_landmarks.copy()
-    gt_normalized[:, 0] /= img_width
-    gt_normalized[:, 1] /= img_height
-    
-    # Normalize predictions
-    pred_normalized = pred_landmarks.copy()
-    pred_normalized[:, 0] /= img_width
-    pred_normalized[:, 1] /= img_height
-    
-    # Calculate inter-ocular distance
-    eye_dist = np.linalg.norm(gt_normalized[8] - gt_normalized[11])
-    eye_dist = max(eye_dist, 1e-5)
-    
-    # Calculate mean error
-    errors = np.linalg.norm(pred_normalized - gt_normalized, axis=1)
-    mean_error = np.mean(errors)
-    nme = mean_error / eye_dist
-    
-    total_nme += nme
+img_paths = [os.path.join(image_dir, f) for f in test_files]
+
+
+def load_sample(img_file):
+    """Load one ground-truth label file and decode its image"""
+    gt = load_landmarks(os.path.join(label_dir, img_file.replace('.png', '.json')))
+    image = Image.open(os.path.join(image_dir, img_file)).convert('RGB')
+    return gt, image
+
+
+# Label parsing and image decoding are I/O / GIL-releasing C code, so load them on a thread pool
+with ThreadPoolExecutor(max_workers=8) as pool:
+    gt_landmarks, images = zip(*pool.map(load_sample, test_files))
+gt_landmarks = np.stack(gt_landmarks)  # (N, 48, 2)
+
+# (N, 1, 2) width, height - broadcasts against (N, 48, 2) landmark arrays in one divide/multiply
+sizes = np.array([img.size for img in images], dtype=np.float32)[:, None, :]
+
+# Predict every image in a single batched forward pass
+batch = torch.stack([DEFAULT_TRANSFORM(img) for img in images])
+pred_normalized = predict_batch(model, batch, device)  # (N, 48, 2)
+
+# Normalize GT landmarks for NME
+gt_normalized = gt_landmarks / sizes
+
+# Calculate inter-ocular distance
+eye_dist = np.linalg.norm(gt_normalized[:, 8] - gt_normalized[:, 11], axis=1)
+eye_dist = np.maximum(eye_dist, 1e-5)
+
+# Calculate mean error
+errors = np.linalg.norm(pred_normalized - gt_normalized, axis=2)
+nme_values = errors.mean(axis=1) / eye_dist
+total_nme = nme_values.sum()
+
+for img_file, nme in zip(test_files, nme_values):
     print(f"{img_file}: NME = {nme:.6f}")
 
+# Save visualizations on the CPU, after the batched forward pass
+for img_path, image, pred, size in zip(img_paths, images, pred_normalized, sizes):
+    vis_path = img_path.replace('.png', '_landmarks.png').replace('.jpg', '_landmarks.jpg')
+    visualize_landmarks(image, pred * size, vis_path)
+
 avg_nme = total_nme / len(test_files)
 print(f"\n{'='*80}")
 print(f"Average NME on VALIDATION SET ONLY: {avg_nme:.6f}")